@@ -0,0 +1,213 @@
+# Drives the bot handlers with generated updates and reports ingestion throughput and /stats latency.
+# Telegram is replaced by a local stand-in, the database is a new sqlite file in a temporary directory
+# unless --configured-database is passed, then it is the one configured for the bot, which has to be an empty one:
+#   python benchmarks/bot_benchmark.py --messages 20000 --chats 20 --users 200
+#   words_stats_bot_storage=mysql python benchmarks/bot_benchmark.py --configured-database
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from telegram import Update
+from telegram.request import BaseRequest
+from tokenizer_benchmark import generate_messages
+
+
+first_names = ['Иннокентий', 'Анна', 'Олександр', 'Мария', 'John', 'Emily', 'Дмитрий', 'Zoë', 'Ёлка', 'Ali']
+stats_requests = ['word|all|all', 'word|last-week|all', 'word|this-month|all', 'word|prev-day|all', 'char|all|all', 'char|last-day|all',
+                  'gif|all|all', 'gif|last-month|all', 'sticker|all|all', 'sticker|this-week|all', 'word|all|page_0']
+
+
+class FakeTelegramRequest(BaseRequest):
+    # answers bot api calls locally with minimal valid results
+    latency: float
+    sticker_sets: dict
+    calls: int
+
+    def __init__(self, latency: float, sticker_sets: dict):
+        self.latency = latency
+        self.sticker_sets = sticker_sets
+        self.calls = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def message(self, parameters: dict) -> dict:
+        return {'message_id': random.randint(1, 2 ** 31), 'date': int(time.time()), 'chat': {'id': int(parameters.get('chat_id', 1)), 'type': 'supergroup'}, 'text': parameters.get('text', '')}
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data is not None else {}
+        endpoint = url.rsplit('/', 1)[-1]
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Stats', 'username': os.getenv('words_stats_bot_username')}
+        elif endpoint == 'getFile':
+            result = {'file_id': parameters['file_id'], 'file_unique_id': parameters['file_id'][-10:]}
+        elif endpoint == 'getStickerSet':
+            result = {'name': parameters['name'], 'title': parameters['name'], 'sticker_type': 'regular', 'is_animated': False, 'is_video': False,
+                      'stickers': [{'file_id': f'file_{unique_id}', 'file_unique_id': unique_id, 'type': 'regular', 'width': 512, 'height': 512, 'is_animated': False, 'is_video': False}
+                                   for unique_id in self.sticker_sets[parameters['name']]]}
+        elif endpoint == 'answerCallbackQuery':
+            result = True
+        else:
+            result = self.message(parameters)
+        return (200, json.dumps({'ok': True, 'result': result}).encode())
+
+
+class UpdateGenerator:
+    chats: list
+    users: list
+    sticker_sets: dict
+    gifs: list
+    texts: list
+    sent: dict
+    next_update_id: int
+    next_message_id: int
+
+    def __init__(self, chats: int, users: int, seed: int):
+        random.seed(seed)
+        self.chats = [-1000000000000 - i for i in range(1, chats + 1)]
+        self.users = [{'id': 100000 + i, 'is_bot': False, 'first_name': random.choice(first_names), 'username': f'user{i}'} for i in range(users)]
+        self.sticker_sets = {f'set{i}': [f'AgADst{i}x{j}' for j in range(30)] for i in range(5)}
+        self.gifs = [(f'AgADgif{i}', f'CgACAgQAAxkBAAgif{i}') for i in range(50)]
+        self.texts = generate_messages(5000, seed)
+        # chat id -> ids of sent text messages, for edits
+        self.sent = {chat_id: [] for chat_id in self.chats}
+        self.next_update_id = 1
+        self.next_message_id = 1
+
+    def update(self, key: str, payload: dict) -> dict:
+        self.next_update_id += 1
+        return {'update_id': self.next_update_id, key: payload}
+
+    def message(self, chat_id: int, user: dict, date: datetime) -> dict:
+        self.next_message_id += 1
+        return {'message_id': self.next_message_id, 'date': int(date.timestamp()), 'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'}, 'from': user}
+
+    def messages(self, count: int, days: int) -> list:
+        # popular chats, users and items get most of the messages
+        updates = []
+        now = datetime.now(timezone.utc)
+        for i in range(count):
+            chat_id = random.choices(self.chats, weights=range(len(self.chats), 0, -1))[0]
+            user = random.choices(self.users, weights=range(len(self.users), 0, -1))[0]
+            date = now - timedelta(seconds=int((count - i) * days * 86400 / count))
+            kind = random.random()
+            if kind < 0.05 and len(self.sent[chat_id]) > 0:
+                message = dict(random.choice(self.sent[chat_id][-50:]))
+                message['text'] = random.choice(self.texts)
+                message['edit_date'] = int(date.timestamp())
+                updates.append(self.update('edited_message', message))
+                continue
+
+            message = self.message(chat_id, user, date)
+            if kind < 0.75:
+                message['text'] = random.choice(self.texts)
+                self.sent[chat_id].append(message)
+            elif kind < 0.87:
+                set_name = random.choice(list(self.sticker_sets))
+                unique_id = random.choices(self.sticker_sets[set_name], weights=range(30, 0, -1))[0]
+                message['sticker'] = {'file_id': f'file_{unique_id}', 'file_unique_id': unique_id, 'type': 'regular', 'width': 512, 'height': 512,
+                                      'is_animated': False, 'is_video': False, 'set_name': set_name}
+            else:
+                unique_id, file_id = random.choices(self.gifs, weights=range(len(self.gifs), 0, -1))[0]
+                message['animation'] = {'file_id': file_id, 'file_unique_id': unique_id, 'width': 320, 'height': 240, 'duration': 3}
+            updates.append(self.update('message', message))
+        return updates
+
+    def stats_queries(self, count: int) -> list:
+        updates = []
+        for _ in range(count):
+            chat_id = random.choice(self.chats)
+            data = random.choice(stats_requests)
+            if random.random() < 0.3:
+                user = random.choice(self.users)
+                data = data.rsplit('|', 1)[0] + f"|user_{user['id']}_{user['first_name']}"
+            message = self.message(chat_id, self.users[0], datetime.now(timezone.utc))
+            message['text'] = 'Get stats for:'
+            updates.append(self.update('callback_query', {'id': str(self.next_update_id), 'from': self.users[0], 'chat_instance': str(chat_id), 'message': message, 'data': data}))
+        return updates
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def run(arguments, directory: str):
+    # set before main loads .env, which does not override them, so the bot never writes to a live database or sketch snapshot
+    if not arguments.configured_database:
+        os.environ['words_stats_bot_storage'] = 'sqlite'
+        os.environ['words_stats_bot_sqlite_path'] = os.path.join(directory, 'benchmark.db')
+    os.environ['words_stats_bot_sketch_path'] = os.path.join(directory, 'heavy_hitters.pickle')
+    os.environ.setdefault('words_stats_bot_token', '1:benchmark')
+    os.environ.setdefault('words_stats_bot_admin_id', '1')
+    os.environ.setdefault('words_stats_bot_username', 'words_stats_benchmark_bot')
+    os.environ['words_stats_bot_buffer_size'] = str(arguments.buffer_size)
+    os.environ['words_stats_bot_concurrent_updates'] = str(arguments.concurrent_updates)
+    from main import Bot
+
+    generator = UpdateGenerator(arguments.chats, arguments.users, arguments.seed)
+    request = FakeTelegramRequest(arguments.api_latency, generator.sticker_sets)
+    bot = Bot(request)
+    await bot.app.initialize()
+    for chat_id in generator.chats:
+        await bot.db.run(bot.db.create_settings, chat_id)
+
+    updates = [Update.de_json(update, bot.app.bot) for update in generator.messages(arguments.messages, arguments.days)]
+    started = time.perf_counter()
+    if arguments.concurrent_updates > 1:
+        # same path as updates received by polling or webhook
+        await asyncio.gather(*[bot.app.update_processor.process_update(update, bot.app.process_update(update)) for update in updates])
+    else:
+        for update in updates:
+            await bot.app.process_update(update)
+    await bot.flush_buffer()
+    ingestion = time.perf_counter() - started
+    print(f'ingestion: {len(updates)} updates in {ingestion:.2f} s, {len(updates) / ingestion:.0f} updates/s')
+
+    latencies = {}
+    for update in [Update.de_json(update, bot.app.bot) for update in generator.stats_queries(arguments.stats_requests)]:
+        started = time.perf_counter()
+        await bot.app.process_update(update)
+        # user picker pages are measured apart from statistics
+        name = 'users' if '|page_' in update.callback_query.data else update.callback_query.data.split('|')[0]
+        latencies.setdefault(name, []).append(time.perf_counter() - started)
+    every = [latency for values in latencies.values() for latency in values]
+    for name, values in sorted(latencies.items()) + [('all', every)]:
+        print(f'stats {name:>8}: {len(values):6} requests, p50 {percentile(values, 50) * 1000:8.2f} ms, p95 {percentile(values, 95) * 1000:8.2f} ms, p99 {percentile(values, 99) * 1000:8.2f} ms')
+    print(f'stats cache: {bot.stats_cache.hits} hits, {bot.stats_cache.misses} misses, telegram api calls: {request.calls}')
+
+    await bot.app.shutdown()
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark bot handlers without telegram connection')
+    parser.add_argument('--messages', type=int, default=10000, help='number of generated message updates')
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--days', type=int, default=60, help='messages are spread over this many past days')
+    parser.add_argument('--stats-requests', type=int, default=1000)
+    parser.add_argument('--buffer-size', type=int, default=0, help='enables buffered ingestion')
+    parser.add_argument('--concurrent-updates', type=int, default=1, help='updates of different chats processed at once')
+    parser.add_argument('--api-latency', type=float, default=0, help='simulated telegram api latency in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--configured-database', action='store_true', help='use the database configured for the bot instead of a temporary sqlite file')
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(parser.parse_args(), directory))
@@ -0,0 +1,98 @@
+# Measures /me reports on a temporary sqlite database: the five statistics of a report run at the same time on the stats pool,
+# so a report should take about as long as its slowest query, not as long as all of them in a row:
+#   python benchmarks/report_benchmark.py --messages 200000 --stats-pool-size 5
+#   python benchmarks/report_benchmark.py --stats-pool-size 2
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from buffer import IngestionBuffer
+from migrate import migrate
+from sqlite_database import SQLiteDatabase
+from tokenizer import SinglePassTokenizer
+from tokenizer_benchmark import generate_messages
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def fill(db: SQLiteDatabase, arguments):
+    # one chat with popular users, about a tenth of the messages are stickers or gifs
+    random.seed(arguments.seed)
+    tokenizer = SinglePassTokenizer()
+    texts = [tokenizer.tokenize(text) for text in generate_messages(5000, arguments.seed)]
+    users = list(range(1, arguments.users + 1))
+    buffer = IngestionBuffer(10000, 0)
+    now = datetime.utcnow()
+    for message_id in range(1, arguments.messages + 1):
+        user_id = random.choices(users, weights=range(len(users), 0, -1))[0]
+        date = now - timedelta(seconds=int((arguments.messages - message_id) * arguments.days * 86400 / arguments.messages))
+        buffer.add_user(user_id, f'user{user_id}', f'User {user_id}')
+        kind = random.random()
+        if kind < 0.9:
+            buffer.add_message_with_words(message_id, date, arguments.chat_id, user_id, random.choice(texts))
+        elif kind < 0.95:
+            buffer.add_message_with_sticker(message_id, date, arguments.chat_id, user_id, f'AgADst{random.randint(1, 100)}', 'set')
+        else:
+            gif = random.randint(1, 50)
+            buffer.add_message_with_gif(message_id, date, arguments.chat_id, user_id, f'AgADgif{gif}', f'CgACAgQAAxkBAAgif{gif}', 3, 240, 320)
+        if buffer.is_full():
+            db.add_batch(buffer.take())
+    db.add_batch(buffer.take())
+
+
+async def run(arguments, directory: str):
+    db = SQLiteDatabase(os.path.join(directory, 'benchmark.db'), 2, arguments.stats_pool_size, 60, 60, 100000)
+    migrate(db)
+    db.create_settings(arguments.chat_id)
+    started = time.perf_counter()
+    fill(db, arguments)
+    print(f'filled: {arguments.messages} messages in {time.perf_counter() - started:.2f} s')
+
+    # same queries and limits as Bot.get_user_report, sliding windows end now and read the raw messages of their first day
+    queries = [(db.get_stats_for_words, (20,)), (db.get_stats_for_characters, ()), (db.get_stats_for_gif, (3,)), (db.get_stats_for_sticker, (3,)), (db.get_stats_for_activity, ())]
+    windows = {'all': (datetime.min, datetime.max), 'last-week': (datetime.utcnow() - timedelta(days=7), datetime.max)}
+    slowest, in_a_row, reports = [], [], []
+    # query name -> seconds
+    single = {query.__name__: [] for query, _ in queries}
+    for _ in range(arguments.reports):
+        user_id = None if random.random() < 0.3 else random.randint(1, arguments.users)
+        start, end = random.choice(list(windows.values()))
+        seconds = []
+        for query, limit in queries:
+            started = time.perf_counter()
+            await db.run_stats(query, arguments.chat_id, user_id, start, end, *limit)
+            seconds.append(time.perf_counter() - started)
+            single[query.__name__].append(seconds[-1])
+        slowest.append(max(seconds))
+        in_a_row.append(sum(seconds))
+        started = time.perf_counter()
+        await asyncio.gather(*[db.run_stats(query, arguments.chat_id, user_id, start, end, *limit) for query, limit in queries])
+        reports.append(time.perf_counter() - started)
+
+    print(f'stats pool of {arguments.stats_pool_size} connections, {arguments.reports} reports')
+    for name, values in list(single.items()) + [('slowest query', slowest), ('queries in a row', in_a_row), ('report', reports)]:
+        print(f'{name:>25}: p50 {percentile(values, 50) * 1000:8.2f} ms, p95 {percentile(values, 95) * 1000:8.2f} ms')
+    print(f'report / slowest query: {percentile(reports, 50) / percentile(slowest, 50):.2f}')
+    db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark user reports against their slowest statistics query')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=60, help='messages are spread over this many past days')
+    parser.add_argument('--reports', type=int, default=100)
+    parser.add_argument('--stats-pool-size', type=int, default=5, help='words_stats_bot_sqlite_stats_pool_size of the bot')
+    parser.add_argument('--chat-id', type=int, default=-1000000000001)
+    parser.add_argument('--seed', type=int, default=1)
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(parser.parse_args(), directory))
@@ -0,0 +1,54 @@
+# Compares tokenizers on generated chat messages: python benchmarks/tokenizer_benchmark.py [messages]
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tokenizer import tokenizers
+
+
+words_ru = ['привет', 'всем', 'как', 'дела', 'ёжик', 'ёлки-палки', 'сегодня', 'завтра', 'Москва', 'ИННОКЕНТИЙ', 'лол', 'кек', 'да', 'нет', 'что', 'это']
+words_uk = ['привіт', 'їжак', 'дякую', "м'ята", 'Євген']
+words_en = ['hello', "don't", 'you', 'THINK', 'so', 'well-known', 'lol', 'ok', 'bot', 'stats']
+others = ['2023', '100%', '—', '!', '?', ',', '...', '😂', '👍', '#tag', '@user', 'x2', "'quoted'", 'İstanbul', 'straße']
+links = ['https://example.com/путь?x=1', 'http://t.me/joinchat/AAA', 'HTTPS://YOUTU.BE/abc', 'see:https://x.y', 'https://']
+
+
+def generate_messages(count: int, seed: int = 1) -> list:
+    random.seed(seed)
+    vocabulary = words_ru * 4 + words_uk + words_en * 2 + others
+    messages = []
+    for _ in range(count):
+        length = random.choice([1, 2, 3, 5, 8, 13, 40])
+        tokens = [random.choice(vocabulary) for _ in range(length)]
+        if random.random() < 0.1:
+            tokens.insert(random.randint(0, length), random.choice(links))
+        messages.append(' '.join(tokens))
+    return messages
+
+
+def generate_noise(count: int, seed: int = 2) -> list:
+    alphabet = list("htps:/ -'0129aZЯяİ_ё.\n\tHTTPSéß") + ['http://', 'https://', 'HTTPS://']
+    random.seed(seed)
+    return [''.join(random.choice(alphabet) for _ in range(random.randint(0, 25))) for _ in range(count)]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    messages = generate_messages(count)
+
+    # every tokenizer has to produce exactly the words of the original regex pair
+    reference = tokenizers['regex']()
+    for name, tokenizer in tokenizers.items():
+        for text in messages + generate_noise(count * 10):
+            if tokenizer().tokenize(text) != reference.tokenize(text):
+                sys.exit(f'{name} differs from regex on {text!r}')
+
+    # most chat messages are a few words, so they are measured on their own too
+    for title, sample in (('all', messages), ('short', [message for message in messages if len(message.split()) <= 3])):
+        print(f'{title} messages: {len(sample)} messages, {sum(len(message) for message in sample)} characters, best of 5 runs')
+        for name, tokenizer_class in tokenizers.items():
+            tokenizer = tokenizer_class()
+            seconds = min(timeit.repeat(lambda: [tokenizer.tokenize(message) for message in sample], number=1, repeat=5))
+            print(f'{name:>12}: {len(sample) / seconds:12.0f} messages/s')
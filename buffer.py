@@ -0,0 +1,97 @@
+from datetime import datetime
+
+
+class IngestionBatch:
+    users: dict
+    messages: list
+    words: list
+    gifs: list
+    stickers: list
+    failures: int
+
+    def __init__(self):
+        # user id -> (user id, nickname, first name), last seen profile wins
+        self.users = {}
+        # (message id, date, chat id, user id, id of replied message or None)
+        self.messages = []
+        # (chat id, message id, [words])
+        self.words = []
+        # (chat id, message id, gif unique id, gif id, duration, height, width)
+        self.gifs = []
+        # (chat id, message id, sticker unique id, sticker set name)
+        self.stickers = []
+        # flushes of the batch that failed
+        self.failures = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+
+class IngestionBuffer:
+    batch: IngestionBatch
+    max_size: int
+    max_delay: float
+    max_failures: int
+
+    def __init__(self, max_size: int, max_delay: float, max_failures: int = 10):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # failed flushes of a batch before its messages are dropped, so a batch the database rejects does not grow the buffer forever
+        self.max_failures = max_failures
+        self.batch = IngestionBatch()
+
+    def __len__(self) -> int:
+        return len(self.batch)
+
+    def add_user(self, user_id: int, nickname: str, first_name: str):
+        self.batch.users[user_id] = (user_id, nickname, first_name)
+
+    def add_message(self, message_id: int, date: datetime, chat_id: int, user_id: int, reply_to: int = None):
+        self.batch.messages.append((message_id, date, chat_id, user_id, reply_to))
+
+    def add_message_with_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, words: list, reply_to: int = None):
+        self.add_message(message_id, date, chat_id, user_id, reply_to)
+        self.batch.words.append((chat_id, message_id, words))
+
+    def add_message_with_gif(self, message_id: int, date: datetime, chat_id: int, user_id: int, gif_unique_id: str, gif_id: str, duration: int, height: int, width: int, reply_to: int = None):
+        self.add_message(message_id, date, chat_id, user_id, reply_to)
+        self.batch.gifs.append((chat_id, message_id, gif_unique_id, gif_id, duration, height, width))
+
+    def add_message_with_sticker(self, message_id: int, date: datetime, chat_id: int, user_id: int, sticker_unique_id: str, sticker_set_name: str, reply_to: int = None):
+        self.add_message(message_id, date, chat_id, user_id, reply_to)
+        self.batch.stickers.append((chat_id, message_id, sticker_unique_id, sticker_set_name))
+
+    def replace_words(self, chat_id: int, message_id: int, words: list) -> bool:
+        # edits a queued message, returns False if it is not in the buffer
+        for i in range(len(self.batch.words) - 1, -1, -1):
+            if self.batch.words[i][:2] == (chat_id, message_id):
+                if len(words) > 0:
+                    self.batch.words[i] = (chat_id, message_id, words)
+                else:
+                    # messages without words are not stored
+                    del self.batch.words[i]
+                    self.batch.messages = [message for message in self.batch.messages if (message[2], message[0]) != (chat_id, message_id)]
+                return True
+        return False
+
+    def is_full(self) -> bool:
+        return len(self.batch) >= self.max_size
+
+    def take(self) -> IngestionBatch:
+        # hand over everything queued so far and start a new batch
+        batch = self.batch
+        self.batch = IngestionBatch()
+        return batch
+
+    def put_back(self, batch: IngestionBatch) -> bool:
+        # a batch that was not written goes before everything queued since, returns False if it failed too many times
+        batch.failures += 1
+        if batch.failures >= self.max_failures:
+            return False
+        batch.users.update(self.batch.users)
+        batch.messages += self.batch.messages
+        batch.words += self.batch.words
+        batch.gifs += self.batch.gifs
+        batch.stickers += self.batch.stickers
+        self.batch = batch
+        return True
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    items: OrderedDict
+    max_size: int
+    ttl: float
+    lock: threading.Lock
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int, ttl: float = None):
+        # key -> (value, expiration time)
+        self.items = OrderedDict()
+        self.max_size = max_size
+        # seconds after which an item is dropped, items never expire without it
+        self.ttl = ttl
+        # caches are shared between database worker threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            if item[1] is not None and item[1] <= time.monotonic():
+                del self.items[key]
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.lock:
+            self.items[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            self.items.move_to_end(key)
+            # drop least recently used items
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class StatsCache:
+    results: LRUCache
+    chat_keys: dict
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int):
+        # (chat id, user id, type, start, end) -> query result
+        self.results = LRUCache(max_size)
+        # chat id -> keys of results cached for the chat
+        self.chat_keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, key: tuple, result, ttl: float):
+        self.results.set(key, result, ttl)
+        self.chat_keys.setdefault(key[0], set()).add(key)
+
+    def invalidate(self, chat_id: int, date=None):
+        # drop results of the chat whose window contains date, or all of them without date
+        keys = self.chat_keys.get(chat_id)
+        if keys is None:
+            return
+        for key in list(keys):
+            if date is None or key[3] <= date <= key[4]:
+                self.results.delete(key)
+                keys.discard(key)
+            elif self.results.get(key) is None:
+                # already expired or evicted
+                keys.discard(key)
+        if len(keys) == 0:
+            del self.chat_keys[chat_id]
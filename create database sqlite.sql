@@ -0,0 +1,103 @@
+-- Schema of 'create database.sql' after migration 001 for the embedded SQLite storage, applied to new databases, later changes are in migrations/sqlite
+CREATE TABLE IF NOT EXISTS Settings(
+    ChatID BIGINT,
+    IgnoreTextFromPhoto BIT,
+    IgnoreTextFromVideo BIT,
+    IgnoreTextFromDocument BIT,
+    IgnoreGif BIT,
+    IgnoreStickers BIT,
+    IgnoreChannelPosts BIT,
+    ShowNames BIT,
+    PRIMARY KEY (ChatID)
+);
+
+CREATE TABLE IF NOT EXISTS Users(
+    UserID BIGINT,
+    Nickname VARCHAR(32) UNIQUE,
+    FirstName VARCHAR(64),
+    PRIMARY KEY (UserID)
+);
+
+CREATE TABLE IF NOT EXISTS Words(
+    WordID INTEGER PRIMARY KEY,
+    Word VARCHAR(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS Messages(
+    MessageID BIGINT,
+    Date DATETIME,
+    ChatID BIGINT,
+    UserID BIGINT,
+    PRIMARY KEY (MessageID),
+    FOREIGN KEY (UserID) REFERENCES Users(UserID)
+);
+
+CREATE TABLE IF NOT EXISTS Messages_Words(
+    MessageID BIGINT,
+    WordID BIGINT,
+    FOREIGN KEY (MessageID) REFERENCES Messages(MessageID) ON DELETE CASCADE,
+    FOREIGN KEY (WordID) REFERENCES Words(WordID) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS Messages_Words_MessageID ON Messages_Words(MessageID);
+
+CREATE TABLE IF NOT EXISTS Gifs(
+    GifUniqueID VARCHAR(20),
+    MessageID BIGINT,
+    GifID VARCHAR(100),
+    Duration INT,
+    Height INT,
+    Width INT,
+    PRIMARY KEY(GifUniqueID, MessageID),
+    FOREIGN KEY (MessageID) REFERENCES Messages(MessageID) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS Gifs_MessageID ON Gifs(MessageID);
+
+CREATE TABLE IF NOT EXISTS Stickers(
+    StickerUniqueID VARCHAR(20),
+    MessageID BIGINT,
+    StickerSetName VARCHAR(65),
+    PRIMARY KEY(StickerUniqueID, MessageID),
+    FOREIGN KEY (MessageID) REFERENCES Messages(MessageID) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS Stickers_MessageID ON Stickers(MessageID);
+
+CREATE TABLE IF NOT EXISTS Daily_Words(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    WordID BIGINT,
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, WordID),
+    FOREIGN KEY (WordID) REFERENCES Words(WordID) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS Daily_Words_ChatID_Day ON Daily_Words(ChatID, Day);
+
+CREATE TABLE IF NOT EXISTS Daily_Characters(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    Count BIGINT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day)
+);
+CREATE INDEX IF NOT EXISTS Daily_Characters_ChatID_Day ON Daily_Characters(ChatID, Day);
+
+CREATE TABLE IF NOT EXISTS Daily_Gifs(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    GifUniqueID VARCHAR(20),
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, GifUniqueID)
+);
+CREATE INDEX IF NOT EXISTS Daily_Gifs_ChatID_Day ON Daily_Gifs(ChatID, Day);
+
+CREATE TABLE IF NOT EXISTS Daily_Stickers(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    StickerUniqueID VARCHAR(20),
+    StickerSetName VARCHAR(65),
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, StickerUniqueID)
+);
+CREATE INDEX IF NOT EXISTS Daily_Stickers_ChatID_Day ON Daily_Stickers(ChatID, Day);
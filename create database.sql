@@ -1,3 +1,4 @@
+-- Initial schema, the bot upgrades it on start (or 'python migrate.py' does) with the migrations in migrations/mysql
 CREATE DATABASE words_stats_telegram_bot;
 USE words_stats_telegram_bot;
 
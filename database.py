@@ -0,0 +1,716 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from collections import Counter
+from buffer import IngestionBatch
+from dictionary import WordDictionary
+from rollups import RollupBatch, window_source
+from metrics import query_seconds, query_wait_seconds, query_errors, queries_in_flight
+import threading
+import asyncio
+import time
+
+
+def utc(date: datetime) -> datetime:
+    # dates of telegram are aware, dates read from database are naive utc
+    return date if date.tzinfo is None else date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+class Database:
+    # storage interface used by the bot, engines provide connections and the statements that differ between them;
+    # queries use %s placeholders and are run in worker threads with a connection per worker,
+    # statistics queries have their own workers and connections, so slow statistics do not hold up ingestion
+    executor: ThreadPoolExecutor
+    stats_executor: ThreadPoolExecutor
+    pool_size: int
+    stats_pool_size: int
+    query_timeout: float
+    stats_timeout: float
+    words: WordDictionary
+    errors: threading.local
+    worker: threading.local
+    engine = 'mysql'
+    insert_ignore = 'INSERT IGNORE'
+    char_length = 'CHAR_LENGTH'
+    # utc hour of a date column
+    hour_of = 'HOUR({})'
+
+    def __init__(self, pool_size: int, stats_pool_size: int, query_timeout: float, stats_timeout: float, word_cache_size: int):
+        # worker thread -> whether it runs statistics queries and takes connections of the statistics pool
+        self.worker = threading.local()
+        # one worker per pooled connection, so a worker never waits for a free connection
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+        self.stats_executor = ThreadPoolExecutor(max_workers=stats_pool_size, thread_name_prefix='db-stats', initializer=self.init_stats_worker)
+        self.pool_size = pool_size
+        self.stats_pool_size = stats_pool_size
+        self.query_timeout = query_timeout
+        self.stats_timeout = stats_timeout
+        self.words = WordDictionary(word_cache_size, self.insert_ignore)
+        # worker thread -> whether its current query logged an error
+        self.errors = threading.local()
+
+    def init_stats_worker(self):
+        self.worker.stats = True
+
+    def get_connection(self, stats: bool):
+        # connections of the statistics pool stop their queries on the server after stats_timeout
+        raise NotImplementedError
+
+    def get_stream_connection(self):
+        # connection outside of the pool that reads rows as they are fetched, for exports that run longer than queries
+        raise NotImplementedError
+
+    def release_connection(self, db):
+        db.close()
+
+    def upsert(self, table: str, columns: tuple, keys: tuple, add: tuple = (), replace: tuple = (), least: tuple = (), greatest: tuple = ()) -> str:
+        # insert rows, on duplicate keys add to the columns in add, overwrite the columns in replace
+        # and keep the smaller or the bigger value in the columns in least and greatest
+        raise NotImplementedError
+
+    @contextmanager
+    def connection(self):
+        db = self.get_connection(getattr(self.worker, 'stats', False))
+        try:
+            yield db
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            # returns connection to the pool
+            self.release_connection(db)
+
+    def log_error(self, message: str):
+        self.errors.failed = True
+        print(datetime.now(), message)
+
+    def measure(self, func, args: tuple, queued: float) -> tuple:
+        # returns result, seconds waited for a worker, seconds of running and whether an error was logged
+        started = time.perf_counter()
+        self.errors.failed = False
+        result = func(*args)
+        return (result, started - queued, time.perf_counter() - started, self.errors.failed)
+
+    async def run(self, func, *args, timeout: float = None, executor: ThreadPoolExecutor = None):
+        # run blocking database method in worker thread, so event loop keeps processing updates
+        timeout = self.query_timeout if timeout is None else timeout
+        executor = self.executor if executor is None else executor
+        queries_in_flight.inc()
+        try:
+            result, waited, elapsed, failed = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(executor, self.measure, func, args, time.perf_counter()), timeout)
+        except asyncio.TimeoutError:
+            # handler does not wait for the query anymore, statistics queries are also stopped by the server soon after
+            print(datetime.now(), f'Query {func.__name__} with arguments {args} timed out after {timeout} seconds')
+            query_errors.inc(func.__name__)
+            return None
+        finally:
+            queries_in_flight.inc(amount=-1)
+
+        query_wait_seconds.observe(waited, func.__name__)
+        query_seconds.observe(elapsed, func.__name__)
+        if failed:
+            query_errors.inc(func.__name__)
+        return result
+
+    async def run_stats(self, func, *args):
+        return await self.run(func, *args, timeout=self.stats_timeout, executor=self.stats_executor)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.stats_executor.shutdown(wait=True)
+
+
+    # region settings and adding messages
+    def create_settings(self, chat_id: int):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute(f"{self.insert_ignore} INTO Settings(ChatID,IgnoreTextFromPhoto,IgnoreTextFromVideo,IgnoreTextFromDocument,IgnoreGif,IgnoreStickers,IgnoreChannelPosts)VALUES(%s,0,0,0,0,0,1);", (chat_id,))
+                db.commit()
+            print(datetime.now(), f'Added to chat {chat_id}')
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot create settings for chat {chat_id}: {e}')
+            return False
+
+    def delete_settings(self, chat_id: int):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute("DELETE FROM Settings WHERE ChatID=%s;", (chat_id,))
+                db.commit()
+            print(datetime.now(), f'Deleted from chat {chat_id}')
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot delete settings for chat {chat_id}: {e}')
+            return False
+
+    def add_user(self, user_id: int, nickname: str, first_name: str) -> bool:
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                self.add_users(cursor, [(user_id, nickname, first_name)])
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot add user {user_id} with nickname {nickname} and first name {first_name}: {e}')
+            return False
+
+    def add_users(self, cursor, users: list):
+        # nicknames are unique, so take them away from users who used them before
+        nicknames = [(user[1], user[0]) for user in users if user[1] is not None]
+        if len(nicknames) > 0:
+            cursor.executemany("UPDATE Users SET Nickname=NULL WHERE Nickname=%s AND UserID<>%s;", nicknames)
+        cursor.executemany(self.upsert('Users', ('UserID', 'Nickname', 'FirstName'), ('UserID',), replace=('Nickname', 'FirstName')), users)
+
+    def add_missing_users(self, users: list) -> bool:
+        # adds (user id, nickname, first name) of users that are not stored yet, known profiles are kept
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.executemany(f"{self.insert_ignore} INTO Users(UserID,Nickname,FirstName) VALUES(%s,%s,%s);", users)
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot add {len(users)} users: {e}')
+            return False
+
+    def add_message(self, cursor, rollups: RollupBatch, message_id: int, date: datetime, chat_id: int, user_id: int, reply_to: int):
+        cursor.execute("INSERT INTO Messages(MessageID,Date,ChatID,UserID,ReplyTo)VALUES(%s,%s,%s,%s,%s);", (message_id, date, chat_id, user_id, reply_to))
+        self.add_chat_users(cursor, [(chat_id, user_id, date, date, 1)])
+        rollups.add_message(chat_id, user_id, date, reply_to)
+
+    def add_chat_users(self, cursor, users: list):
+        # (chat id, user id, first message date, last message date, messages)
+        cursor.executemany(self.upsert('Chat_Users', ('ChatID', 'UserID', 'FirstSeen', 'LastSeen', 'Messages'), ('ChatID', 'UserID'),
+                                       add=('Messages',), least=('FirstSeen',), greatest=('LastSeen',)), users)
+
+    def delete_message(self, chat_id: int, message_id: int):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute("SELECT UserID,Date,ReplyTo FROM Messages WHERE ChatID=%s AND MessageID=%s;", (chat_id, message_id))
+                message = cursor.fetchone()
+                if message is None:
+                    return True
+                user_id, date, reply_to = message
+
+                # take message out of daily rollups
+                rollups = RollupBatch()
+                rollups.add_message(chat_id, user_id, date, reply_to, -1)
+                cursor.execute(f"SELECT mw.WordID,mw.Count,{self.char_length}(w.Word) FROM Messages_Words mw JOIN Words w ON mw.WordID=w.WordID WHERE mw.ChatID=%s AND mw.MessageID=%s;", (chat_id, message_id))
+                words = cursor.fetchall()
+                if len(words) > 0:
+                    rollups.add_words(chat_id, user_id, date, {word[0]: word[1] for word in words}, sum([word[1] * word[2] for word in words]), -1)
+                cursor.execute("SELECT GifUniqueID FROM Gifs WHERE ChatID=%s AND MessageID=%s;", (chat_id, message_id))
+                for gif in cursor.fetchall():
+                    rollups.add_gif(chat_id, user_id, date, gif[0], -1)
+                cursor.execute("SELECT StickerUniqueID,StickerSetName FROM Stickers WHERE ChatID=%s AND MessageID=%s;", (chat_id, message_id))
+                for sticker in cursor.fetchall():
+                    rollups.add_sticker(chat_id, user_id, date, sticker[0], sticker[1], -1)
+                rollups.write(cursor, self)
+
+                cursor.execute("DELETE FROM Messages WHERE ChatID=%s AND MessageID=%s;", (chat_id, message_id))
+                cursor.execute("UPDATE Chat_Users SET Messages=Messages-1 WHERE ChatID=%s AND UserID=%s;", (chat_id, user_id))
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot delete message {message_id} for chat {chat_id}: {e}')
+            return False
+
+    def add_message_with_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, words: list, reply_to: int = None) -> bool:
+        try:
+            with self.connection() as db:
+                word_ids = self.words.get_ids(db, words)
+                cursor = db.cursor()
+                rollups = RollupBatch()
+                self.add_message(cursor, rollups, message_id, date, chat_id, user_id, reply_to)
+                # add words to message, every word once with number of its occurrences
+                words = [word for word in words if word in word_ids]
+                counts = Counter([word_ids[word] for word in words])
+                cursor.executemany("INSERT INTO Messages_Words(ChatID,MessageID,WordID,Count) VALUES(%s,%s,%s,%s);", [(chat_id, message_id, word_id, count) for word_id, count in counts.items()])
+                rollups.add_words(chat_id, user_id, date, counts, sum([len(word) for word in words]))
+                rollups.write(cursor, self)
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot add message {message_id} on {date} for chat {chat_id}, user {user_id} and words {words}: {e}')
+            return False
+
+    def edit_message_with_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, words: list, reply_to: int = None) -> bool:
+        # writes only words added or removed by the edit, the message keeps its original date
+        if len(words) == 0:
+            return self.delete_message(chat_id, message_id)
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute("SELECT UserID,Date FROM Messages WHERE ChatID=%s AND MessageID=%s;", (chat_id, message_id))
+                message = cursor.fetchone()
+                if message is not None:
+                    user_id, date = message
+                    word_ids = self.words.get_ids(db, words)
+                    cursor.execute(f"SELECT mw.WordID,mw.Count,{self.char_length}(w.Word) FROM Messages_Words mw JOIN Words w ON mw.WordID=w.WordID WHERE mw.ChatID=%s AND mw.MessageID=%s;", (chat_id, message_id))
+                    stored = cursor.fetchall()
+                    # word id -> characters
+                    lengths = {word_id: length for word_id, _, length in stored}
+                    lengths.update({word_ids[word]: len(word) for word in word_ids})
+                    old = Counter({word_id: count for word_id, count, _ in stored})
+                    new = Counter([word_ids[word] for word in words if word in word_ids])
+                    removed = old - new
+                    added = new - old
+
+                    # words that are gone are deleted, words with changed number of occurrences are overwritten
+                    deleted = [(chat_id, message_id, word_id) for word_id in old if word_id not in new]
+                    if len(deleted) > 0:
+                        cursor.executemany("DELETE FROM Messages_Words WHERE ChatID=%s AND MessageID=%s AND WordID=%s;", deleted)
+                    changed = [(chat_id, message_id, word_id, count) for word_id, count in new.items() if old[word_id] != count]
+                    if len(changed) > 0:
+                        cursor.executemany(self.upsert('Messages_Words', ('ChatID', 'MessageID', 'WordID', 'Count'), ('ChatID', 'MessageID', 'WordID'), replace=('Count',)), changed)
+
+                    rollups = RollupBatch()
+                    rollups.add_words(chat_id, user_id, date, removed, sum([lengths[word_id] * count for word_id, count in removed.items()]), -1)
+                    rollups.add_words(chat_id, user_id, date, added, sum([lengths[word_id] * count for word_id, count in added.items()]))
+                    rollups.write(cursor, self)
+                    db.commit()
+                    return True
+                # statistics of deleted old messages are only in the rollups, so their edits cannot be applied
+                compacted_before = self.get_compacted_before(cursor, [chat_id]).get(chat_id)
+                if compacted_before is not None and utc(date) < compacted_before:
+                    return True
+        except Exception as e:
+            self.log_error(f'Cannot edit message {message_id} for chat {chat_id} with words {words}: {e}')
+            return False
+        # message was not stored before, e.g. it had no words
+        return self.add_message_with_words(message_id, date, chat_id, user_id, words, reply_to)
+
+    def add_message_with_gif(self, message_id: int, date: datetime, chat_id: int, user_id: int, gif_unique_id: str, gif_id: str, duration: int, height: int, width: int, reply_to: int = None) -> bool:
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                rollups = RollupBatch()
+                self.add_message(cursor, rollups, message_id, date, chat_id, user_id, reply_to)
+                cursor.execute(f"{self.insert_ignore} INTO Gifs(ChatID,MessageID,GifUniqueID,GifID,Duration,Height,Width)VALUES(%s,%s,%s,%s,%s,%s,%s);", (chat_id, message_id, gif_unique_id, gif_id, duration, height, width))
+                cursor.execute(f"{self.insert_ignore} INTO Gif_Files(ChatID,GifUniqueID,GifID,Duration,Height,Width)VALUES(%s,%s,%s,%s,%s,%s);", (chat_id, gif_unique_id, gif_id, duration, height, width))
+                rollups.add_gif(chat_id, user_id, date, gif_unique_id)
+                rollups.write(cursor, self)
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot add message {message_id} on {date} for chat {chat_id} for user {user_id} with gif {gif_unique_id}: {e}')
+            return False
+
+    def add_message_with_sticker(self, message_id: int, date: datetime, chat_id: int, user_id: int, sticker_unique_id: str, sticker_set_name: str, reply_to: int = None) -> bool:
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                rollups = RollupBatch()
+                self.add_message(cursor, rollups, message_id, date, chat_id, user_id, reply_to)
+                cursor.execute(f"{self.insert_ignore} INTO Stickers(ChatID,MessageID,StickerUniqueID,StickerSetName)VALUES(%s,%s,%s,%s);", (chat_id, message_id, sticker_unique_id, sticker_set_name))
+                rollups.add_sticker(chat_id, user_id, date, sticker_unique_id, sticker_set_name)
+                rollups.write(cursor, self)
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot add message {message_id} on {date} for chat {chat_id} for user {user_id} with sticker {sticker_unique_id}: {e}')
+            return False
+
+    def add_batch(self, batch: IngestionBatch) -> bool:
+        try:
+            with self.connection() as db:
+                word_ids = self.words.get_ids(db, [word for _, _, message_words in batch.words for word in message_words])
+                cursor = db.cursor()
+                if len(batch.users) > 0:
+                    self.add_users(cursor, list(batch.users.values()))
+
+                # keep only the first copy of every message that is not stored yet, like add_message does
+                message_keys = list({(message[2], message[0]) for message in batch.messages})
+                stored = set()
+                for i in range(0, len(message_keys), self.words.chunk_size):
+                    chunk = message_keys[i:i + self.words.chunk_size]
+                    cursor.execute(f"SELECT ChatID,MessageID FROM Messages WHERE (ChatID,MessageID) IN({','.join(['(%s,%s)'] * len(chunk))});", [value for key in chunk for value in key])
+                    stored.update({tuple(row) for row in cursor.fetchall()})
+                # messages older than deleted raw messages may have been counted in the rollups already, e.g. by an import
+                compacted_before = self.get_compacted_before(cursor, list({message[2] for message in batch.messages}))
+                # (chat id, message id) -> message
+                messages = {}
+                for message in batch.messages:
+                    if message[2] in compacted_before and utc(message[1]) < compacted_before[message[2]]:
+                        continue
+                    if (message[2], message[0]) not in stored:
+                        stored.add((message[2], message[0]))
+                        messages[(message[2], message[0])] = message
+
+                # words of the first copy of every message, a word is stored once per message
+                words = []
+                stored_words = set()
+                for chat_id, message_id, message_words in batch.words:
+                    if (chat_id, message_id) in messages and (chat_id, message_id) not in stored_words:
+                        stored_words.add((chat_id, message_id))
+                        words.append((chat_id, message_id, [word for word in message_words if word in word_ids]))
+                gifs = [gif for gif in batch.gifs if gif[:2] in messages]
+                stickers = [sticker for sticker in batch.stickers if sticker[:2] in messages]
+
+                rollups = RollupBatch()
+                for message_id, date, chat_id, user_id, reply_to in messages.values():
+                    rollups.add_message(chat_id, user_id, date, reply_to)
+                for chat_id, message_id, message_words in words:
+                    _, date, _, user_id, _ = messages[(chat_id, message_id)]
+                    rollups.add_words(chat_id, user_id, date, Counter([word_ids[word] for word in message_words]), sum([len(word) for word in message_words]))
+                for gif in gifs:
+                    _, date, chat_id, user_id, _ = messages[gif[:2]]
+                    rollups.add_gif(chat_id, user_id, date, gif[2])
+                for sticker in stickers:
+                    _, date, chat_id, user_id, _ = messages[sticker[:2]]
+                    rollups.add_sticker(chat_id, user_id, date, sticker[2], sticker[3])
+
+                if len(messages) > 0:
+                    cursor.executemany("INSERT INTO Messages(MessageID,Date,ChatID,UserID,ReplyTo) VALUES(%s,%s,%s,%s,%s);", list(messages.values()))
+                    # (chat id, user id) -> [first date, last date, messages]
+                    chat_users = {}
+                    for _, date, chat_id, user_id, _ in messages.values():
+                        chat_user = chat_users.get((chat_id, user_id))
+                        if chat_user is None:
+                            chat_users[(chat_id, user_id)] = [date, date, 1]
+                        else:
+                            chat_user[0] = min(chat_user[0], date)
+                            chat_user[1] = max(chat_user[1], date)
+                            chat_user[2] += 1
+                    self.add_chat_users(cursor, [key + tuple(value) for key, value in chat_users.items()])
+                if len(words) > 0:
+                    cursor.executemany("INSERT INTO Messages_Words(ChatID,MessageID,WordID,Count) VALUES(%s,%s,%s,%s);",
+                                       [(chat_id, message_id, word_id, count) for chat_id, message_id, message_words in words for word_id, count in Counter([word_ids[word] for word in message_words]).items()])
+                if len(gifs) > 0:
+                    cursor.executemany(f"{self.insert_ignore} INTO Gifs(ChatID,MessageID,GifUniqueID,GifID,Duration,Height,Width) VALUES(%s,%s,%s,%s,%s,%s,%s);", gifs)
+                    cursor.executemany(f"{self.insert_ignore} INTO Gif_Files(ChatID,GifUniqueID,GifID,Duration,Height,Width) VALUES(%s,%s,%s,%s,%s,%s);", [(gif[0],) + gif[2:] for gif in gifs])
+                if len(stickers) > 0:
+                    cursor.executemany(f"{self.insert_ignore} INTO Stickers(ChatID,MessageID,StickerUniqueID,StickerSetName) VALUES(%s,%s,%s,%s);", stickers)
+                rollups.write(cursor, self)
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot add batch of {len(batch)} messages: {e}')
+            return False
+
+    def get_settings(self, chat_id: int):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT IgnoreTextFromPhoto,IgnoreTextFromVideo,IgnoreTextFromDocument,IgnoreGif,IgnoreStickers,IgnoreChannelPosts FROM Settings WHERE ChatID=%s;', (chat_id,))
+                result = cursor.fetchall()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get settings for chat {chat_id}: {e}')
+            return None
+
+    def get_import_progress(self, chat_id: int):
+        # id of the last message of the chat read from an export
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT LastMessageID FROM Imports WHERE ChatID=%s;', (chat_id,))
+                result = cursor.fetchone()
+            return 0 if result is None else result[0]
+        except Exception as e:
+            self.log_error(f'Cannot get import progress for chat {chat_id}: {e}')
+            return None
+
+    def set_import_progress(self, chat_id: int, message_id: int) -> bool:
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute(self.upsert('Imports', ('ChatID', 'LastMessageID'), ('ChatID',), replace=('LastMessageID',)), (chat_id, message_id))
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot set import progress for chat {chat_id} to message {message_id}: {e}')
+            return False
+
+    def get_users(self, chat_id: int, num: int, after: tuple = None, before: tuple = None):
+        # (user id, nickname, first name, messages) of up to num users of the chat, most active first,
+        # pages continue after or before (messages, user id) of the last or first user of another page
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                query = 'SELECT u.UserID,u.Nickname,u.FirstName,cu.Messages FROM Chat_Users cu JOIN Users u ON cu.UserID=u.UserID WHERE cu.ChatID=%s'
+                params = [chat_id]
+                if after is not None:
+                    query += ' AND (cu.Messages,cu.UserID)<(%s,%s) ORDER BY cu.Messages DESC,cu.UserID DESC'
+                    params += list(after)
+                elif before is not None:
+                    # previous page is read backwards from its end
+                    query += ' AND (cu.Messages,cu.UserID)>(%s,%s) ORDER BY cu.Messages,cu.UserID'
+                    params += list(before)
+                else:
+                    query += ' ORDER BY cu.Messages DESC,cu.UserID DESC'
+                cursor.execute(query + ' LIMIT %s;', params + [num])
+                result = cursor.fetchall()
+            return result if before is None else result[::-1]
+        except Exception as e:
+            self.log_error(f'Cannot get {num} users for chat {chat_id} after {after} and before {before}: {e}')
+            return None
+    # endregion
+
+    # region retention
+    def get_retention(self, default_days: int):
+        # (chat id, days) of chats whose raw messages are deleted after some days, chats without own horizon have the default one
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT s.ChatID,r.Days FROM Settings s LEFT JOIN Retention r ON s.ChatID=r.ChatID;')
+                chats = [(chat_id, default_days if days is None else days) for chat_id, days in cursor.fetchall()]
+            # 0 days keeps messages of the chat forever
+            return [(chat_id, days) for chat_id, days in chats if days is not None and days > 0]
+        except Exception as e:
+            self.log_error(f'Cannot get retention of chats: {e}')
+            return None
+
+    def set_retention(self, chat_id: int, days: int) -> bool:
+        # days is None for the default horizon
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute(self.upsert('Retention', ('ChatID', 'Days'), ('ChatID',), replace=('Days',)), (chat_id, days))
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot set retention of chat {chat_id} to {days} days: {e}')
+            return False
+
+    def get_compacted_before(self, cursor, chat_ids: list) -> dict:
+        # chat id -> date raw messages of the chat are deleted before
+        if len(chat_ids) == 0:
+            return {}
+        cursor.execute(f"SELECT ChatID,CompactedBefore FROM Retention WHERE CompactedBefore IS NOT NULL AND ChatID IN({','.join(['%s'] * len(chat_ids))});", chat_ids)
+        return {chat_id: compacted_before for chat_id, compacted_before in cursor.fetchall()}
+
+    def set_compacted_before(self, chat_id: int, before: datetime) -> bool:
+        # the date only moves forward, so messages deleted once are never stored again
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute(f'{self.insert_ignore} INTO Retention(ChatID) VALUES(%s);', (chat_id,))
+                cursor.execute('UPDATE Retention SET CompactedBefore=%s WHERE ChatID=%s AND (CompactedBefore IS NULL OR CompactedBefore<%s);', (before, chat_id, before))
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot set compaction date of chat {chat_id} to {before}: {e}')
+            return False
+
+    def compact_messages(self, chat_id: int, before: datetime, batch_size: int):
+        # deletes up to batch size oldest raw messages sent before the date, returns number of deleted messages,
+        # their statistics stay in the daily rollups, which are not changed
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT MessageID FROM Messages WHERE ChatID=%s AND Date<%s ORDER BY Date LIMIT %s;', (chat_id, before, batch_size))
+                message_ids = [row[0] for row in cursor.fetchall()]
+                if len(message_ids) > 0:
+                    # words, gifs and stickers of the messages are deleted by foreign keys
+                    cursor.execute(f"DELETE FROM Messages WHERE ChatID=%s AND MessageID IN({','.join(['%s'] * len(message_ids))});", [chat_id] + message_ids)
+                db.commit()
+            return len(message_ids)
+        except Exception as e:
+            self.log_error(f'Cannot delete messages of chat {chat_id} before {before}: {e}')
+            return None
+    # endregion
+
+    # region closed windows
+    def get_active_chats(self, since: datetime):
+        # chats with messages after the date
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT DISTINCT ChatID FROM Chat_Users WHERE LastSeen>=%s;', (since,))
+                result = [row[0] for row in cursor.fetchall()]
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get chats active since {since}: {e}')
+            return None
+
+    def get_closed_stats(self, chat_id: int, user_id: int, type: str, start: datetime, end: datetime):
+        # rows with json result of the window, no rows if it was not computed yet
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute('SELECT Result FROM Closed_Stats WHERE ChatID=%s AND UserID=%s AND Type=%s AND WindowStart=%s AND WindowEnd=%s;', (chat_id, user_id or 0, type, start, end))
+                result = cursor.fetchall()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get closed stats for {type} for chat {chat_id}, user {user_id} between {start} and {end}: {e}')
+            return None
+
+    def set_closed_stats(self, chat_id: int, user_id: int, type: str, start: datetime, end: datetime, result: str) -> bool:
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute(self.upsert('Closed_Stats', ('ChatID', 'UserID', 'Type', 'WindowStart', 'WindowEnd', 'Result'), ('ChatID', 'UserID', 'Type', 'WindowStart', 'WindowEnd'), replace=('Result',)),
+                               (chat_id, user_id or 0, type, start, end, result))
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot set closed stats for {type} for chat {chat_id}, user {user_id} between {start} and {end}: {e}')
+            return False
+
+    def delete_closed_stats(self, chat_dates: list) -> bool:
+        # forgets results of every (chat id, date) whose window contains the date, or all results of the chat without date
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                chats = [(chat_id,) for chat_id, date in chat_dates if date is None]
+                dates = [(chat_id, date, date) for chat_id, date in chat_dates if date is not None]
+                if len(chats) > 0:
+                    cursor.executemany('DELETE FROM Closed_Stats WHERE ChatID=%s;', chats)
+                if len(dates) > 0:
+                    cursor.executemany('DELETE FROM Closed_Stats WHERE ChatID=%s AND WindowStart<=%s AND WindowEnd>=%s;', dates)
+                db.commit()
+            return True
+        except Exception as e:
+            self.log_error(f'Cannot delete closed stats of {len(chat_dates)} chat dates: {e}')
+            return False
+
+    def delete_old_closed_stats(self, windows: list):
+        # forgets results of every chat and user whose window is not one of the (start, end) windows that are shown now
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                cursor.execute(f"DELETE FROM Closed_Stats WHERE NOT({' OR '.join(['(WindowStart=%s AND WindowEnd=%s)'] * len(windows))});", [bound for window in windows for bound in window])
+                result = cursor.rowcount
+                db.commit()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot delete old closed stats: {e}')
+            return None
+    # endregion
+
+    # region statistics
+    # statistics read whole days from daily rollups and only partial days from raw messages
+    def get_stats_for_words(self, chat_id: int, user_id: int, start: datetime, end: datetime, limit: int = 20):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                source, params = window_source('SELECT WordID,Count FROM Daily_Words WHERE ChatID=%s',
+                                               'SELECT mw.WordID,mw.Count FROM Messages m JOIN Messages_Words mw ON m.ChatID=mw.ChatID AND m.MessageID=mw.MessageID WHERE m.ChatID=%s',
+                                               chat_id, user_id, start, end)
+                cursor.execute(f'SELECT w.Word,SUM(t.Count) FROM({source})t JOIN Words w ON t.WordID=w.WordID GROUP BY w.WordID HAVING SUM(t.Count)>0 ORDER BY 2 DESC LIMIT %s;', params + [limit])
+                result = cursor.fetchall()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get stats for words for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
+            return None
+
+    def get_stats_for_characters(self, chat_id: int, user_id: int, start: datetime, end: datetime):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                source, params = window_source('SELECT Count FROM Daily_Characters WHERE ChatID=%s',
+                                               f'SELECT {self.char_length}(w.Word)*mw.Count AS Count FROM Messages m JOIN Messages_Words mw ON m.ChatID=mw.ChatID AND m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID WHERE m.ChatID=%s',
+                                               chat_id, user_id, start, end)
+                cursor.execute(f'SELECT SUM(t.Count) FROM({source})t;', params)
+                result = cursor.fetchone()[0]
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get stats for characters for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
+            return None
+
+    def get_stats_for_gif(self, chat_id: int, user_id: int, start: datetime, end: datetime, limit: int = 3):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                source, params = window_source('SELECT GifUniqueID,Count FROM Daily_Gifs WHERE ChatID=%s',
+                                               'SELECT g.GifUniqueID,1 AS Count FROM Gifs g JOIN Messages m ON g.ChatID=m.ChatID AND g.MessageID=m.MessageID WHERE m.ChatID=%s',
+                                               chat_id, user_id, start, end)
+                # gif details are the ones of its first message in the chat
+                cursor.execute(f'SELECT TopGifs.GifCount,g.GifUniqueID,g.GifID,g.Duration,g.Height,g.Width FROM(SELECT GifUniqueID,SUM(Count) AS GifCount FROM({source})t GROUP BY GifUniqueID HAVING GifCount>0 ORDER BY GifCount DESC LIMIT %s)TopGifs JOIN Gif_Files g ON g.ChatID=%s AND g.GifUniqueID=TopGifs.GifUniqueID ORDER BY TopGifs.GifCount DESC;', params + [limit, chat_id])
+                result = cursor.fetchall()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get stats for gifs for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
+            return None
+
+    def get_stats_for_sticker(self, chat_id: int, user_id: int, start: datetime, end: datetime, limit: int = 3):
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                source, params = window_source('SELECT StickerUniqueID,StickerSetName,Count FROM Daily_Stickers WHERE ChatID=%s',
+                                               'SELECT s.StickerUniqueID,s.StickerSetName,1 AS Count FROM Stickers s JOIN Messages m ON s.ChatID=m.ChatID AND s.MessageID=m.MessageID WHERE m.ChatID=%s',
+                                               chat_id, user_id, start, end)
+                cursor.execute(f'SELECT StickerUniqueID,StickerSetName,SUM(t.Count) FROM({source})t GROUP BY StickerUniqueID,StickerSetName HAVING SUM(t.Count)>0 ORDER BY 3 DESC LIMIT %s;', params + [limit])
+                result = cursor.fetchall()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get stats for stickers for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
+            return None
+
+    def get_stats_for_activity(self, chat_id: int, user_id: int, start: datetime, end: datetime):
+        # (utc hour, messages, replies) of hours with messages
+        try:
+            with self.connection() as db:
+                cursor = db.cursor()
+                source, params = window_source('SELECT Hour,Count,Replies FROM Daily_Activity WHERE ChatID=%s',
+                                               f"SELECT {self.hour_of.format('m.Date')} AS Hour,1 AS Count,CASE WHEN m.ReplyTo IS NULL THEN 0 ELSE 1 END AS Replies FROM Messages m WHERE m.ChatID=%s",
+                                               chat_id, user_id, start, end)
+                cursor.execute(f'SELECT Hour,SUM(Count),SUM(Replies) FROM({source})t GROUP BY Hour HAVING SUM(Count)>0 ORDER BY Hour;', params)
+                result = cursor.fetchall()
+            return result
+        except Exception as e:
+            self.log_error(f'Cannot get stats for activity for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
+            return None
+    # endregion
+
+    # region export
+    def get_export_query(self, type: str, chat_id: int, start: datetime, end: datetime) -> tuple:
+        # (column names, query, params) of all rows of a statistics table of the chat, without limits
+        if type == 'words':
+            source, params = window_source('SELECT WordID,Count FROM Daily_Words WHERE ChatID=%s',
+                                           'SELECT mw.WordID,mw.Count FROM Messages m JOIN Messages_Words mw ON m.ChatID=mw.ChatID AND m.MessageID=mw.MessageID WHERE m.ChatID=%s',
+                                           chat_id, None, start, end)
+            return (('word', 'count'), f'SELECT w.Word,SUM(t.Count) FROM({source})t JOIN Words w ON t.WordID=w.WordID GROUP BY w.WordID HAVING SUM(t.Count)>0 ORDER BY 2 DESC;', params)
+        if type == 'gifs':
+            source, params = window_source('SELECT GifUniqueID,Count FROM Daily_Gifs WHERE ChatID=%s',
+                                           'SELECT g.GifUniqueID,1 AS Count FROM Gifs g JOIN Messages m ON g.ChatID=m.ChatID AND g.MessageID=m.MessageID WHERE m.ChatID=%s',
+                                           chat_id, None, start, end)
+            return (('gif_unique_id', 'count'), f'SELECT GifUniqueID,SUM(Count) FROM({source})t GROUP BY GifUniqueID HAVING SUM(Count)>0 ORDER BY 2 DESC;', params)
+        if type == 'stickers':
+            source, params = window_source('SELECT StickerUniqueID,StickerSetName,Count FROM Daily_Stickers WHERE ChatID=%s',
+                                           'SELECT s.StickerUniqueID,s.StickerSetName,1 AS Count FROM Stickers s JOIN Messages m ON s.ChatID=m.ChatID AND s.MessageID=m.MessageID WHERE m.ChatID=%s',
+                                           chat_id, None, start, end)
+            return (('sticker_unique_id', 'sticker_set_name', 'count'), f'SELECT StickerUniqueID,StickerSetName,SUM(Count) FROM({source})t GROUP BY StickerUniqueID,StickerSetName HAVING SUM(Count)>0 ORDER BY 3 DESC;', params)
+        if type == 'users':
+            activity, activity_params = window_source('SELECT UserID,Count,Replies FROM Daily_Activity WHERE ChatID=%s',
+                                                      'SELECT m.UserID,1 AS Count,CASE WHEN m.ReplyTo IS NULL THEN 0 ELSE 1 END AS Replies FROM Messages m WHERE m.ChatID=%s',
+                                                      chat_id, None, start, end)
+            characters, characters_params = window_source('SELECT UserID,Count FROM Daily_Characters WHERE ChatID=%s',
+                                                          f'SELECT m.UserID,{self.char_length}(w.Word)*mw.Count AS Count FROM Messages m JOIN Messages_Words mw ON m.ChatID=mw.ChatID AND m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID WHERE m.ChatID=%s',
+                                                          chat_id, None, start, end)
+            return (('user_id', 'nickname', 'first_name', 'messages', 'replies', 'characters'),
+                    f'SELECT u.UserID,u.Nickname,u.FirstName,a.Messages,a.Replies,COALESCE(c.Characters,0) FROM(SELECT UserID,SUM(Count) AS Messages,SUM(Replies) AS Replies FROM({activity})t GROUP BY UserID HAVING SUM(Count)>0)a '
+                    f'JOIN Users u ON a.UserID=u.UserID LEFT JOIN(SELECT UserID,SUM(Count) AS Characters FROM({characters})t GROUP BY UserID)c ON a.UserID=c.UserID ORDER BY a.Messages DESC,u.UserID;',
+                    activity_params + characters_params)
+        raise ValueError(f'Unknown export type {type}')
+
+    def export_stats(self, type: str, chat_id: int, start: datetime, end: datetime, header, write, batch_size: int = 1000):
+        # passes column names to header and rows to write as they are read, so memory does not grow with the chat,
+        # runs on its own connection and thread, so it neither waits for nor holds database workers of live updates
+        columns, query, params = self.get_export_query(type, chat_id, start, end)
+        try:
+            db = self.get_stream_connection()
+            try:
+                cursor = db.cursor()
+                cursor.execute(query, params)
+                header(columns)
+                count = 0
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    for row in rows:
+                        write(row)
+                    count += len(rows)
+                cursor.close()
+            finally:
+                db.close()
+            return count
+        except Exception as e:
+            print(datetime.now(), f'Cannot export {type} of chat {chat_id} between {start} and {end}: {e}')
+            return None
+    # endregion
@@ -0,0 +1,48 @@
+from cache import LRUCache
+
+
+class WordDictionary:
+    cache: LRUCache
+    insert_ignore: str
+    chunk_size = 1000
+
+    def __init__(self, max_size: int, insert_ignore: str = 'INSERT IGNORE'):
+        # word -> WordID of recently used words
+        self.cache = LRUCache(max_size)
+        # statement of the database engine that skips words stored meanwhile
+        self.insert_ignore = insert_ignore
+
+    def select_ids(self, cursor, words: list) -> dict:
+        ids = {}
+        for i in range(0, len(words), self.chunk_size):
+            chunk = words[i:i + self.chunk_size]
+            cursor.execute(f"SELECT WordID,Word FROM Words WHERE Word IN({','.join(['%s'] * len(chunk))});", chunk)
+            ids.update({word: word_id for word_id, word in cursor.fetchall()})
+        return ids
+
+    def get_ids(self, db, words) -> dict:
+        # returns word -> WordID, words that cannot be stored (e.g. too long) are left out
+        ids = {}
+        missing = []
+        for word in set(words):
+            word_id = self.cache.get(word)
+            if word_id is None:
+                missing.append(word)
+            else:
+                ids[word] = word_id
+        if len(missing) == 0:
+            return ids
+
+        cursor = db.cursor()
+        found = self.select_ids(cursor, missing)
+        new = [word for word in missing if word not in found]
+        if len(new) > 0:
+            cursor.executemany(f"{self.insert_ignore} INTO Words(Word) VALUES(%s);", [(word,) for word in new])
+            # words are committed on their own, so cached ids stay valid even if the message is rolled back
+            db.commit()
+            found.update(self.select_ids(cursor, new))
+
+        for word, word_id in found.items():
+            self.cache.set(word, word_id)
+        ids.update(found)
+        return ids
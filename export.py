@@ -0,0 +1,35 @@
+import gzip
+import json
+import csv
+
+
+class ExportFile:
+    # gzip compressed csv or json lines file written one row at a time
+    formats = ('csv', 'jsonl')
+    format: str
+    path: str
+    file: gzip.GzipFile
+    writer: object
+    columns: tuple
+
+    def __init__(self, path: str, format: str):
+        self.format = format
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file) if format == 'csv' else None
+        self.columns = ()
+
+    def header(self, columns: tuple):
+        self.columns = columns
+        if self.writer is not None:
+            self.writer.writerow(columns)
+
+    def write(self, row: tuple):
+        if self.writer is not None:
+            self.writer.writerow(row)
+        else:
+            # sums are decimals in mysql
+            self.file.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=int) + '\n')
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,201 @@
+from datetime import datetime, timedelta
+from collections import Counter
+from cache import LRUCache
+from database import utc
+import heapq
+import pickle
+import os
+
+
+class SpaceSaving:
+    # top items of a stream in a fixed number of counters: when all counters are taken, a new item replaces the item
+    # with the smallest count and inherits that count as its error, so a count is never below the true one
+    # and above it by at most the smallest count, which is at most (total of the stream) / capacity
+    capacity: int
+    counts: dict
+    heap: list
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # item -> [count, error]
+        self.counts = {}
+        # (count, item) with outdated entries, smallest current count is found lazily
+        self.heap = []
+
+    def add(self, item, count: int = 1):
+        counter = self.counts.get(item)
+        if counter is None:
+            error = 0
+            if len(self.counts) >= self.capacity:
+                error = self.pop_min()
+            counter = self.counts[item] = [error, error]
+        counter[0] += count
+        heapq.heappush(self.heap, (counter[0], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(counter[0], item) for item, counter in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, item, count: int = 1):
+        # removed occurrences of replaced items are lost, which only makes their error smaller
+        counter = self.counts.get(item)
+        if counter is not None:
+            counter[0] = max(counter[0] - count, 0)
+            counter[1] = min(counter[1], counter[0])
+            heapq.heappush(self.heap, (counter[0], item))
+
+    def pop_min(self) -> int:
+        while True:
+            count, item = heapq.heappop(self.heap)
+            counter = self.counts.get(item)
+            if counter is not None and counter[0] == count:
+                del self.counts[item]
+                return count
+
+    def min_count(self) -> int:
+        # upper bound of the count of every item that is not kept
+        if len(self.counts) < self.capacity:
+            return 0
+        return min([counter[0] for counter in self.counts.values()])
+
+    def copy(self):
+        # counters are shared with the copy, so a snapshot is consistent up to counts changed while it is pickled
+        sketch = SpaceSaving(self.capacity)
+        sketch.counts = dict(self.counts)
+        return sketch
+
+    def __getstate__(self):
+        return (self.capacity, self.counts)
+
+    def __setstate__(self, state):
+        self.capacity, self.counts = state
+        self.heap = [(counter[0], item) for item, counter in self.counts.items()]
+        heapq.heapify(self.heap)
+
+
+class HeavyHitters:
+    # top words and stickers of recent hours of every chat and user, for short statistics windows without queries,
+    # a window is answered from hourly sketches, so it is widened to whole hours,
+    # and every count is off by at most the sum of the smallest counts of the merged sketches, reported as error
+    capacity: int
+    hours: int
+    sketches: dict
+    since: dict
+    started: datetime
+    messages: LRUCache
+    path: str
+
+    def __init__(self, capacity: int, hours: int, messages_size: int, path: str):
+        self.capacity = capacity
+        # hours kept, a day and the current hour cover both last day and this day
+        self.hours = hours
+        # (chat id, user id or None for the whole chat, type, hour) -> SpaceSaving
+        self.sketches = {}
+        # chat id -> time counting of the chat started again after it lost messages, e.g. by an import
+        self.since = {}
+        self.started = datetime.utcnow()
+        # (chat id, message id) -> (user id, hour, word counts) of recent messages, so edits can be applied
+        self.messages = LRUCache(messages_size)
+        self.path = path
+
+    def hour(self, date: datetime) -> datetime:
+        return utc(date).replace(minute=0, second=0, microsecond=0)
+
+    def covers(self, chat_id: int, date: datetime) -> bool:
+        # messages sent before counting started are not counted, e.g. updates a crashed worker gets again,
+        # which may be in the loaded sketches already, windows that start before are answered by queries anyway
+        return utc(date) >= max(self.started, self.since.get(chat_id, self.started))
+
+    def add(self, chat_id: int, user_id: int, type: str, hour: datetime, items: dict, sign: int = 1):
+        if len(items) == 0 or hour < datetime.utcnow() - timedelta(hours=self.hours):
+            return
+        for user in (None, user_id):
+            key = (chat_id, user, type, hour)
+            sketch = self.sketches.get(key)
+            if sketch is None:
+                sketch = self.sketches[key] = SpaceSaving(self.capacity)
+            for item, count in items.items():
+                if sign > 0:
+                    sketch.add(item, count)
+                else:
+                    sketch.remove(item, count)
+
+    def add_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, words: list):
+        if not self.covers(chat_id, date):
+            return
+        hour = self.hour(date)
+        counts = Counter(words)
+        self.messages.set((chat_id, message_id), (user_id, hour, counts))
+        self.add(chat_id, user_id, 'word', hour, counts)
+
+    def edit_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, words: list):
+        # hours before the kept ones are not counted, so their edits change nothing
+        if self.hour(date) < datetime.utcnow() - timedelta(hours=self.hours):
+            return
+        message = self.messages.get((chat_id, message_id))
+        if message is None:
+            # words of older messages are not kept, an edit of a message counted in the sketches makes them inexact
+            if self.covers(chat_id, date):
+                self.reset(chat_id)
+            return
+        user_id, hour, old = message
+        new = Counter(words)
+        self.add(chat_id, user_id, 'word', hour, old - new, -1)
+        self.add(chat_id, user_id, 'word', hour, new - old)
+        self.messages.set((chat_id, message_id), (user_id, hour, new))
+
+    def add_sticker(self, date: datetime, chat_id: int, user_id: int, sticker_unique_id: str, sticker_set_name: str):
+        if not self.covers(chat_id, date):
+            return
+        self.add(chat_id, user_id, 'sticker', self.hour(date), {(sticker_unique_id, sticker_set_name): 1})
+
+    def reset(self, chat_id: int):
+        # chat is answered by queries until its sketches cover whole windows again
+        self.since[chat_id] = datetime.utcnow()
+        self.sketches = {key: sketch for key, sketch in self.sketches.items() if key[0] != chat_id}
+
+    def expire(self):
+        oldest = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=self.hours)
+        self.sketches = {key: sketch for key, sketch in self.sketches.items() if key[3] >= oldest}
+        self.since = {chat_id: since for chat_id, since in self.since.items() if since >= oldest}
+
+    def top(self, chat_id: int, user_id: int, type: str, start: datetime, end: datetime, limit: int):
+        # returns (items, error) for windows that end now, or None if the sketches do not cover the window
+        now = datetime.utcnow()
+        first_hour = start.replace(minute=0, second=0, microsecond=0)
+        if end < now or start < max(self.started, self.since.get(chat_id, self.started)) or first_hour < now - timedelta(hours=self.hours):
+            return None
+        totals = Counter()
+        error = 0
+        for hour in range(int((now - first_hour).total_seconds() // 3600) + 1):
+            sketch = self.sketches.get((chat_id, user_id, type, first_hour + timedelta(hours=hour)))
+            if sketch is not None:
+                for item, counter in sketch.counts.items():
+                    totals[item] += counter[0]
+                error += sketch.min_count()
+        return ([item for item in totals.most_common(limit) if item[1] > 0], error)
+
+    def snapshot(self, clean: bool) -> tuple:
+        # copies of the containers are taken on the event loop, where sketches are updated, and pickled by save in another thread
+        with self.messages.lock:
+            messages = self.messages.items.copy()
+        return ({key: sketch.copy() for key, sketch in self.sketches.items()}, dict(self.since), self.started, messages, clean)
+
+    def save(self, snapshot: tuple):
+        with open(self.path + '.tmp', 'wb') as file:
+            pickle.dump(snapshot, file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as file:
+            sketches, since, started, messages, clean = pickle.load(file)
+        self.sketches = sketches
+        self.since = since
+        self.messages.items = messages
+        # after a clean stop counting continues where the snapshot stopped,
+        # otherwise messages after the snapshot are missing, so only windows that start now are covered
+        if clean:
+            self.started = started
+        self.expire()
+        return True
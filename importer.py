@@ -0,0 +1,225 @@
+from datetime import datetime, timezone
+from buffer import IngestionBatch
+from tokenizer import Tokenizer
+import json
+import asyncio
+
+
+class ExportReader:
+    # reads a telegram desktop json export of one chat message by message, only a few chunks are kept in memory
+    file: object
+    text: str
+    position: int
+    chat: dict
+    decoder: json.JSONDecoder
+    chunk_size = 1 << 20
+
+    def __init__(self, file):
+        self.file = file
+        self.text = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+        # top level values that come before the messages: name, type and id
+        self.chat = {}
+
+        self.expect('{')
+        while True:
+            key = self.decode()
+            self.expect(':')
+            if key == 'messages':
+                break
+            self.chat[key] = self.decode()
+            self.expect(',')
+        if 'id' not in self.chat:
+            raise ValueError('file is not an export of a single chat')
+        self.expect('[')
+
+    def read(self) -> bool:
+        # drops consumed text and appends the next chunk, returns False at the end of file
+        chunk = self.file.read(self.chunk_size)
+        if chunk == '':
+            return False
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            while self.position < len(self.text) and self.text[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.text) or not self.read():
+                return
+
+    def peek(self) -> str:
+        self.skip_whitespace()
+        if self.position >= len(self.text):
+            raise ValueError('unexpected end of export')
+        return self.text[self.position]
+
+    def expect(self, character: str):
+        if self.peek() != character:
+            raise ValueError(f'expected {character!r} at {self.text[self.position:self.position + 20]!r}')
+        self.position += 1
+
+    def decode(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.position)
+                # a number may continue in the next chunk
+                if end < len(self.text) or not self.read():
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                # value continues in the next chunk
+                if not self.read():
+                    raise
+
+    def messages(self):
+        if self.peek() == ']':
+            return
+        while True:
+            yield self.decode()
+            if self.peek() == ']':
+                return
+            self.expect(',')
+
+
+def export_chat_id(chat: dict) -> int:
+    # exports keep chat ids without the prefixes of the bot api
+    if chat.get('type') in ('private_supergroup', 'public_supergroup', 'public_channel', 'private_channel'):
+        return int(f"-100{chat['id']}")
+    if chat.get('type') == 'private_group':
+        return -int(chat['id'])
+    return int(chat['id'])
+
+
+def message_text(message: dict) -> str:
+    # text is a string or a list of strings and formatted parts
+    text = message.get('text', '')
+    if isinstance(text, str):
+        return text
+    return ''.join([part if isinstance(part, str) else part.get('text', '') for part in text])
+
+
+def message_kind(message: dict) -> str:
+    # the handler of the bot that would have received the message
+    media_type = message.get('media_type')
+    if 'photo' in message:
+        return 'photo'
+    if media_type == 'video_file':
+        return 'video'
+    if media_type == 'animation':
+        return 'gif'
+    if media_type == 'sticker':
+        return 'sticker'
+    if media_type is None and 'file' in message:
+        return 'document'
+    if media_type is None:
+        return 'text'
+    return None
+
+
+def is_counted(message: dict, kind: str, text: str, settings: tuple) -> bool:
+    # same rules as Bot.validate_settings
+    if text.startswith('/'):
+        return False
+    if settings[0] and kind == 'photo':
+        return False
+    if settings[1] and kind == 'video':
+        return False
+    if settings[2] and kind == 'document':
+        return False
+    # exports do not tell forwards from users and channels apart, so all forwards count as channel posts
+    if settings[5] and 'forwarded_from' in message:
+        return False
+    return True
+
+
+class HistoryImporter:
+    db: object
+    tokenizer: Tokenizer
+    batch_size: int
+    chat_id: int
+    imported: int
+    skipped: int
+
+    def __init__(self, db, tokenizer: Tokenizer, batch_size: int):
+        self.db = db
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.chat_id = None
+        self.imported = 0
+        self.skipped = 0
+
+    def read_batch(self, messages, chat_id: int, settings: tuple, after: int) -> tuple:
+        # returns batch, users and id of last read message, runs in a worker thread as parsing and tokenizing take most of the time
+        batch = IngestionBatch()
+        users = {}
+        texts = []
+        last_id = None
+        read = 0
+        for message in messages:
+            last_id = message['id']
+            read += 1
+            if last_id > after:
+                kind = message_kind(message)
+                text = message_text(message)
+                # messages from channels or anonymous admins have no user, and exports have no file ids of stickers and gifs
+                if message.get('type') != 'message' or kind not in ('text', 'photo', 'video', 'document') or not str(message.get('from_id', '')).startswith('user') \
+                        or text == '' or not is_counted(message, kind, text, settings):
+                    self.skipped += 1
+                else:
+                    user_id = int(message['from_id'][4:])
+                    users[user_id] = (user_id, None, message.get('from'))
+                    if 'date_unixtime' in message:
+                        date = datetime.fromtimestamp(int(message['date_unixtime']), timezone.utc)
+                    else:
+                        date = datetime.fromisoformat(message['date'])
+                    batch.messages.append((message['id'], date, chat_id, user_id, message.get('reply_to_message_id')))
+                    texts.append((message['id'], text))
+            if read >= self.batch_size:
+                break
+
+        for message_id, text in texts:
+            words = self.tokenizer.tokenize(text)
+            if len(words) > 0:
+                batch.words.append((chat_id, message_id, words))
+        # messages without words are not stored
+        with_words = {message_id for _, message_id, _ in batch.words}
+        self.skipped += len(batch.messages) - len(with_words)
+        batch.messages = [message for message in batch.messages if message[0] in with_words]
+        return (batch, list(users.values()), last_id)
+
+    async def run(self, path: str, chat_id: int = None):
+        # imports the export into the chat, or into the chat of the export without chat id,
+        # can be run again to continue an interrupted import
+        loop = asyncio.get_running_loop()
+        with open(path, encoding='utf-8') as file:
+            reader = await loop.run_in_executor(None, ExportReader, file)
+            chat_id = export_chat_id(reader.chat) if chat_id is None else chat_id
+            self.chat_id = chat_id
+
+            settings = await self.db.run(self.db.get_settings, chat_id)
+            if settings is None or len(settings) == 0:
+                raise ValueError(f'chat {chat_id} has no settings, bot has to be added to the chat first')
+            after = await self.db.run(self.db.get_import_progress, chat_id)
+            if after is None:
+                raise ValueError(f'cannot get import progress for chat {chat_id}')
+            print(datetime.now(), f'Importing {path} into chat {chat_id} after message {after}')
+
+            messages = reader.messages()
+            while True:
+                batch, users, last_id = await loop.run_in_executor(None, self.read_batch, messages, chat_id, settings[0], after)
+                if last_id is None:
+                    break
+                # big batches get the time of a statistics query
+                if len(users) > 0 and not await self.db.run_stats(self.db.add_missing_users, users):
+                    raise ValueError('cannot add users')
+                if len(batch) > 0 and not await self.db.run_stats(self.db.add_batch, batch):
+                    raise ValueError(f'cannot add messages up to message {last_id}')
+                if last_id > after:
+                    await self.db.run(self.db.set_import_progress, chat_id, last_id)
+                    after = last_id
+                self.imported += len(batch)
+        print(datetime.now(), f'Imported {self.imported} messages into chat {chat_id}, skipped {self.skipped}')
@@ -1,34 +1,53 @@
-from telegram.ext import Application, CommandHandler, ChatMemberHandler, MessageHandler, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, ChatMemberHandler, MessageHandler, ContextTypes, CallbackQueryHandler, TypeHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Message, Animation
-from telegram.constants import ChatMemberStatus
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext.filters import TEXT, PHOTO, VIDEO, Document, ANIMATION, Sticker, VIA_BOT
 import os
-import mysql.connector
-from mysql.connector import MySQLConnection
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta, time as day_time
 from dateutil.relativedelta import relativedelta, MO
-import re
+import asyncio
+import functools
+import time
+import json
+import tempfile
+from buffer import IngestionBuffer
+from database import Database
+from mysql_database import MySQLDatabase
+from sqlite_database import SQLiteDatabase
+from migrate import migrate
+from cache import LRUCache, StatsCache
+from tokenizer import Tokenizer, tokenizers
+from importer import HistoryImporter
+from update_processor import ChatOrderedUpdateProcessor, chat_shard
+from heavy_hitters import HeavyHitters
+from export import ExportFile
+from measured_request import MeasuredRequest
+from metrics import registry, Counter, Gauge, handler_seconds, handler_errors, query_seconds, query_errors, queries_in_flight, telegram_seconds, event_loop_lag_seconds, messages_stored
 
 
 load_dotenv()
 
-class Bot:
-    db: MySQLConnection
-    app: Application
-    admin_id: int
-    bot_username: str
-
-    pattern_url = re.compile(r"https?://\S+")
-    pattern_word = re.compile(r"[-'\d]*[^\W\d]+[-'\d]*")
-
-    def __init__(self):
-        print(datetime.now(), 'Starting bot')
-
-        self.admin_id = int(os.getenv('words_stats_bot_admin_id'))
-        self.bot_username = os.getenv('words_stats_bot_username')
-
-        self.db = mysql.connector.connect(
+def connect_database() -> Database:
+    # storage engine is chosen by words_stats_bot_storage, mysql or the embedded sqlite
+    storage = os.getenv('words_stats_bot_storage', 'mysql')
+    pool_size = int(os.getenv(f'words_stats_bot_{storage}_pool_size', 5))
+    # connections of statistics queries, which do not take connections of ingestion
+    # a user report runs five statistics queries at once, so the default pool takes one report without queueing
+    stats_pool_size = int(os.getenv(f'words_stats_bot_{storage}_stats_pool_size', 5))
+    query_timeout = float(os.getenv('words_stats_bot_query_timeout', 10))
+    stats_timeout = float(os.getenv('words_stats_bot_stats_timeout', 60))
+    word_cache_size = int(os.getenv('words_stats_bot_word_cache_size', 100000))
+    if storage == 'sqlite':
+        return SQLiteDatabase(os.getenv('words_stats_bot_sqlite_path', 'words_stats_telegram_bot.db'), pool_size, stats_pool_size, query_timeout, stats_timeout, word_cache_size)
+    else:
+        return MySQLDatabase(
+                pool_size=pool_size,
+                stats_pool_size=stats_pool_size,
+                query_timeout=query_timeout,
+                stats_timeout=stats_timeout,
+                word_cache_size=word_cache_size,
                 host=os.getenv('words_stats_bot_mysql_database_host'),
                 port=int(os.getenv('words_stats_bot_mysql_database_port')),
                 database=os.getenv('words_stats_bot_mysql_database'),
@@ -36,241 +55,429 @@ class Bot:
                 password=os.getenv('words_stats_bot_mysql_password')
             )
 
-        self.app = Application.builder().token(os.getenv('words_stats_bot_token')).build()
+
+def run_application(app: Application):
+    webhook_url = os.getenv('words_stats_bot_webhook_url')
+    if webhook_url:
+        # telegram sends updates to the public url, which has to be forwarded to the local server
+        app.run_webhook(listen=os.getenv('words_stats_bot_webhook_listen', '127.0.0.1'),
+                        port=int(os.getenv('words_stats_bot_webhook_port', 8443)),
+                        url_path=os.getenv('words_stats_bot_webhook_path', ''),
+                        secret_token=os.getenv('words_stats_bot_webhook_secret'),
+                        webhook_url=webhook_url)
+    else:
+        app.run_polling(poll_interval=int(os.getenv('words_stats_bot_update_interval')))
+
+
+class Bot:
+    db: Database
+    app: Application
+    admin_id: int
+    bot_username: str
+    buffer: IngestionBuffer
+    buffer_lock: asyncio.Lock
+    writing: set
+    settings_cache: LRUCache
+    users_cache: LRUCache
+    stats_cache: StatsCache
+    sticker_sets_cache: LRUCache
+    gif_files_cache: LRUCache
+    tokenizer: Tokenizer
+    shard: tuple
+    acks: object
+    unacknowledged: list
+    heavy_hitters: HeavyHitters
+    metrics_server: asyncio.AbstractServer
+    lag_probe: asyncio.Task
+    tasks: set
+    retention_days: int
+    retention_batch_size: int
+    retention_pause: float
+    precompute_pause: float
+    weekly_digest: bool
+    top_words: int
+    top_media: int
+    export_lock: asyncio.Lock
+
+    # partial days of sliding windows are read from raw messages, so raw messages of the longest window (last year) are never deleted
+    min_retention_days = 367
+
+
+    # time -> (rounding of sliding window start, seconds to keep cached statistics)
+    stats_cache_windows = {
+        'all': (None, 3600),
+        'last-year': (timedelta(hours=1), 3600),
+        'last-month': (timedelta(minutes=10), 600),
+        'last-week': (timedelta(minutes=5), 300),
+        'last-day': (timedelta(minutes=1), 60),
+        'prev-year': (None, 86400),
+        'prev-month': (None, 86400),
+        'prev-week': (None, 86400),
+        'prev-day': (None, 86400),
+        'this-year': (None, 3600),
+        'this-month': (None, 3600),
+        'this-week': (None, 3600),
+        'this-day': (None, 3600),
+    }
+    # windows that ended do not change unless old messages are edited or imported, so their results are kept in database
+    closed_windows = ('prev-year', 'prev-month', 'prev-week', 'prev-day')
+    export_types = ('words', 'users', 'gifs', 'stickers')
+    # documents sent by bots are limited to 50 MB
+    max_export_size = 50 * 1024 * 1024
+
+    def __init__(self, request: BaseRequest = None, shard: tuple = None):
+        print(datetime.now(), 'Starting bot' if shard is None else f'Starting worker {shard[0]}')
+        # (index, number of workers) of a worker process, which gets updates of its chats from the front process
+        self.shard = shard
+        # queue of processed update ids of a worker, and ids of processed updates whose messages are still buffered
+        self.acks = None
+        self.unacknowledged = []
+
+        self.admin_id = int(os.getenv('words_stats_bot_admin_id'))
+        self.bot_username = os.getenv('words_stats_bot_username')
+        self.tokenizer = tokenizers[os.getenv('words_stats_bot_tokenizer', 'single-pass')]()
+
+        self.db = connect_database()
+        print(datetime.now(), f'Database schema version {migrate(self.db)}')
+
+        # buffered ingestion is enabled by setting a buffer size, messages are then written in bulk
+        buffer_size = int(os.getenv('words_stats_bot_buffer_size', 0))
+        self.buffer = IngestionBuffer(buffer_size, float(os.getenv('words_stats_bot_buffer_interval', 5)), int(os.getenv('words_stats_bot_buffer_max_failures', 10))) if buffer_size > 0 else None
+        self.buffer_lock = asyncio.Lock()
+        # (chat id, message id) of messages of the batch that is being written
+        self.writing = set()
+
+        # chat id -> settings rows, empty for chats without settings
+        self.settings_cache = LRUCache(int(os.getenv('words_stats_bot_settings_cache_size', 10000)), float(os.getenv('words_stats_bot_settings_cache_ttl', 3600)))
+        # user id -> (nickname, first name) as stored in database
+        self.users_cache = LRUCache(int(os.getenv('words_stats_bot_user_cache_size', 10000)))
+        self.stats_cache = StatsCache(int(os.getenv('words_stats_bot_stats_cache_size', 10000)))
+        # sticker set name -> {sticker unique id -> sticker}, gif file id -> file id resolved by telegram
+        self.sticker_sets_cache = LRUCache(int(os.getenv('words_stats_bot_media_cache_size', 1000)), float(os.getenv('words_stats_bot_media_cache_ttl', 3600)))
+        self.gif_files_cache = LRUCache(int(os.getenv('words_stats_bot_media_cache_size', 1000)), float(os.getenv('words_stats_bot_media_cache_ttl', 3600)))
+
+        # top words and stickers of the last hours are kept in memory for short windows and saved to survive restarts
+        self.heavy_hitters = HeavyHitters(int(os.getenv('words_stats_bot_sketch_capacity', 100)), 25, int(os.getenv('words_stats_bot_sketch_messages', 100000)),
+                                          os.getenv('words_stats_bot_sketch_path', 'heavy_hitters.pickle') + ('' if shard is None else f'.{shard[0]}'))
+        try:
+            if self.heavy_hitters.load():
+                print(datetime.now(), f'Loaded {len(self.heavy_hitters.sketches)} top words and stickers sketches')
+        except Exception as e:
+            print(datetime.now(), f'Cannot load top words and stickers sketches: {e}')
+
+        # raw messages older than the horizon of their chat are deleted, chats without own horizon keep them forever unless a default is set
+        self.retention_days = int(os.getenv('words_stats_bot_retention_days')) if os.getenv('words_stats_bot_retention_days') else None
+        self.retention_batch_size = int(os.getenv('words_stats_bot_retention_batch_size', 1000))
+        self.retention_pause = float(os.getenv('words_stats_bot_retention_pause', 1))
+        # statistics of windows that just ended are computed after midnight, optionally with a digest of the previous week sent on mondays
+        self.precompute_pause = float(os.getenv('words_stats_bot_precompute_pause', 0.5))
+        self.weekly_digest = os.getenv('words_stats_bot_weekly_digest', '').lower() in ('1', 'true', 'yes')
+
+        # number of top words and of top gifs and stickers shown by /stats, full tables are available through /export
+        self.top_words = int(os.getenv('words_stats_bot_top_words', 20))
+        self.top_media = int(os.getenv('words_stats_bot_top_media', 3))
+        # one export runs at a time, each of them reads a whole statistics table
+        self.export_lock = asyncio.Lock()
+
+        builder = Application.builder().token(os.getenv('words_stats_bot_token')).post_init(self.post_init).post_stop(self.post_stop)
+        # updates of different chats are processed concurrently when more than one is allowed
+        concurrent_updates = int(os.getenv('words_stats_bot_concurrent_updates', 1))
+        if concurrent_updates > 1:
+            builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(concurrent_updates))
+        # request replaces connection to telegram, e.g. in benchmarks, requests to telegram are measured either way
+        builder = builder.request(MeasuredRequest(request if request is not None else HTTPXRequest(connection_pool_size=256)))
+        self.app = builder.build()
+        self.metrics_server = None
+        self.lag_probe = None
+        # background queries started by handlers, awaited before the database is closed
+        self.tasks = set()
+        self.add_metrics()
 
         self.app.add_error_handler(self.error)
 
-        self.app.add_handler(CommandHandler('start', self.start_command))
-        self.app.add_handler(CommandHandler('help', self.help_command))
-        self.app.add_handler(CommandHandler('shutdown', self.shutdown_command))
+        if self.buffer is not None:
+            if self.app.job_queue is None:
+                print(datetime.now(), 'Job queue is not available, buffer will be flushed only when full')
+            else:
+                self.app.job_queue.run_repeating(self.flush_buffer_job, interval=self.buffer.max_delay)
+        if self.app.job_queue is None:
+            print(datetime.now(), 'Job queue is not available, old messages will not be deleted')
+        else:
+            self.app.job_queue.run_repeating(self.compact_job, interval=float(os.getenv('words_stats_bot_retention_interval', 3600)), first=60)
+            self.app.job_queue.run_repeating(self.save_heavy_hitters_job, interval=float(os.getenv('words_stats_bot_sketch_snapshot_interval', 300)))
+            self.app.job_queue.run_daily(self.precompute_job, time=day_time(0, 5, tzinfo=timezone.utc))
+
+        self.app.add_handler(CommandHandler('start', self.measured(self.start_command)))
+        self.app.add_handler(CommandHandler('help', self.measured(self.help_command)))
+        self.app.add_handler(CommandHandler('shutdown', self.measured(self.shutdown_command)))
+        self.app.add_handler(CommandHandler('import', self.measured(self.import_command)))
+        self.app.add_handler(CommandHandler('metrics', self.measured(self.metrics_command)))
+        self.app.add_handler(CommandHandler('retention', self.measured(self.retention_command)))
+        self.app.add_handler(CommandHandler('export', self.measured(self.export_command)))
 
-        self.app.add_handler(CommandHandler("stats", self.get_stats_command))
-        self.app.add_handler(CallbackQueryHandler(self.get_stats_buttons))
+        self.app.add_handler(CommandHandler("stats", self.measured(self.get_stats_command)))
+        self.app.add_handler(CommandHandler(["me", "userstats"], self.measured(self.user_report_command)))
+        self.app.add_handler(CallbackQueryHandler(self.measured(self.get_stats_buttons)))
 
-        self.app.add_handler(ChatMemberHandler(self.process_new_group_members, Update.chat_member))
-        self.app.add_handler(MessageHandler(TEXT | VIA_BOT, self.process_text))
-        self.app.add_handler(MessageHandler(ANIMATION, self.process_gif))
-        self.app.add_handler(MessageHandler(Sticker.ALL, self.process_sticker))
-        self.app.add_handler(MessageHandler(PHOTO | VIDEO | Document.ALL, self.process_photo_video_document))
+        self.app.add_handler(ChatMemberHandler(self.measured(self.process_new_group_members), Update.chat_member))
+        self.app.add_handler(MessageHandler(TEXT | VIA_BOT, self.measured(self.process_text)))
+        self.app.add_handler(MessageHandler(ANIMATION, self.measured(self.process_gif)))
+        self.app.add_handler(MessageHandler(Sticker.ALL, self.measured(self.process_sticker)))
+        self.app.add_handler(MessageHandler(PHOTO | VIDEO | Document.ALL, self.measured(self.process_photo_video_document)))
 
 
         #TODO: add setting to show first names or nicknames while getting statistics
         #TODO: add achievements (obtained by request/by stats/everyday/right after achievement (?)/check each hour)
         #TODO: add statistics for number of voice messages
-        #TODO: choose how much top words to show
-        #TODO: add statistics for number of replies
-        #TODO: add full statistics for the user
 
 
     def start(self):
         print(datetime.now(), 'Running bot')
-        self.app.run_polling(poll_interval=int(os.getenv('words_stats_bot_update_interval')))
-
-
-    def split_message(self, message: str) -> list:
-        # lower message and remove all links
-        message_no_url = re.sub(self.pattern_url, '', message.lower())
-        # split into words
-        return re.findall(self.pattern_word, message_no_url)
-
-
-    # region database settings and adding messages
-    def create_settings(self, chat_id: int):
+        run_application(self.app)
+
+    async def process_updates(self, updates, acks):
+        # runs a worker process, updates come from the front process instead of telegram,
+        # every processed update is acknowledged once its messages are stored, so the front sends it again only if the worker crashed before
+        self.acks = acks
+        async def acknowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if self.buffer is None:
+                acks.put((self.shard[0], update.update_id))
+            else:
+                # messages of the update are in the buffer or in a batch that is being written, the next flush stores them
+                self.unacknowledged.append(update.update_id)
+        self.app.add_handler(TypeHandler(Update, acknowledge), group=1)
+
+        loop = asyncio.get_running_loop()
+        async with self.app:
+            await self.post_init(self.app)
+            await self.app.start()
+            while True:
+                data = await loop.run_in_executor(None, updates.get)
+                # None is sent when the front process stops
+                if data is None:
+                    break
+                await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+            await self.app.stop()
+            await self.post_stop(self.app)
+
+
+    # region metrics
+    def measured(self, callback):
+        # handler that records how long it ran and whether it raised
+        @functools.wraps(callback)
+        async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                handler_errors.inc(callback.__name__)
+                raise
+            finally:
+                handler_seconds.observe(time.perf_counter() - started, callback.__name__)
+        return handler
+
+    def add_metrics(self):
+        # values kept by caches and queues are read when metrics are rendered
+        caches = {'settings': self.settings_cache, 'users': self.users_cache, 'stats': self.stats_cache, 'sticker_sets': self.sticker_sets_cache,
+                  'gif_files': self.gif_files_cache, 'words': self.db.words.cache}
+        registry.add(Counter('words_stats_bot_cache_hits_total', 'Cache lookups that found a value', ('cache',), lambda: {(name,): cache.hits for name, cache in caches.items()}))
+        registry.add(Counter('words_stats_bot_cache_misses_total', 'Cache lookups that found no value', ('cache',), lambda: {(name,): cache.misses for name, cache in caches.items()}))
+        registry.add(Gauge('words_stats_bot_queue_depth', 'Messages waiting in the buffer and updates waiting for handlers', ('queue',), self.queue_depths))
+
+    def queue_depths(self) -> dict:
+        return {('buffer',): 0 if self.buffer is None else len(self.buffer), ('updates',): self.app.update_queue.qsize()}
+
+    def count_stored(self, type: str, stored: bool) -> bool:
+        if stored:
+            messages_stored.inc(type)
+        return stored
+
+    async def probe_event_loop_lag(self):
+        # a timer fires late by the time the event loop was blocked by other work
+        while True:
+            expected = time.perf_counter() + 1
+            await asyncio.sleep(1)
+            event_loop_lag_seconds.observe(time.perf_counter() - expected)
+
+    async def serve_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # minimal http server for prometheus, every request gets the metrics
         try:
-            cursor = self.db.cursor()
-            cursor.execute("INSERT IGNORE INTO Settings(ChatID,IgnoreTextFromPhoto,IgnoreTextFromVideo,IgnoreTextFromDocument,IgnoreGif,IgnoreStickers,IgnoreChannelPosts)VALUE(%s,0,0,0,0,0,1);", (chat_id,))
-            self.db.commit()
-            print(datetime.now(), f'Added to chat {chat_id}')
-            return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot create settings for chat {chat_id}: {e}')
-            return False
+            while (await reader.readline()).strip() != b'':
+                pass
+            body = registry.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def split_text(self, text: str, limit: int = 4096) -> list:
+        # parts of whole lines that fit into a telegram message, longer lines are cut
+        parts = ['']
+        for line in text.split('\n'):
+            line = line[:limit]
+            if parts[-1] and len(parts[-1]) + len(line) + 1 > limit:
+                parts.append('')
+            parts[-1] += ('\n' if parts[-1] else '') + line
+        return parts
+
+    def summarize(self, histogram, errors) -> list:
+        # count, mean and 95th percentile of each label, slowest first
+        lines = []
+        for labels, (_, total, count) in sorted(histogram.values.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{labels[0]}: {count}, mean {total / count * 1000:.1f} ms, p95 <= {histogram.quantile(labels, 0.95) * 1000:g} ms, errors {errors.values.get(labels, 0) if errors is not None else 0:g}')
+        return lines
+
+    def get_metrics_summary(self) -> str:
+        lines = ['Handlers:'] + self.summarize(handler_seconds, handler_errors)
+        lines += ['', 'Queries:'] + self.summarize(query_seconds, query_errors)
+        lines += ['', 'Telegram requests:'] + self.summarize(telegram_seconds, None)
+        if () in event_loop_lag_seconds.values:
+            lines += ['', f'Event loop lag: p95 <= {event_loop_lag_seconds.quantile((), 0.95) * 1000:g} ms']
+        lines += ['', 'Caches:']
+        for name, cache in (('settings', self.settings_cache), ('users', self.users_cache), ('stats', self.stats_cache), ('sticker sets', self.sticker_sets_cache),
+                            ('gif files', self.gif_files_cache), ('words', self.db.words.cache)):
+            lookups = cache.hits + cache.misses
+            lines.append(f'{name}: {lookups} lookups, hit rate {cache.hits / lookups * 100 if lookups > 0 else 0:.1f}%')
+        lines += ['', 'Queues:'] + [f'{labels[0]}: {depth}' for labels, depth in self.queue_depths().items()]
+        lines += ['', 'Stored:'] + [f'{labels[0]}: {count:g}' for labels, count in messages_stored.values.items()]
+        return '\n'.join(lines)
+    # endregion
 
-    def delete_settings(self, chat_id: int):
-        try:
-            cursor = self.db.cursor()
-            cursor.execute("DELETE IGNORE FROM Settings WHERE ChatID=%s;", (chat_id,))
-            self.db.commit()
-            print(datetime.now(), f'Deleted from chat {chat_id}')
-            return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot delete settings for chat {chat_id}: {e}')
-            return False
 
-    def add_user(self, user_id: int, nickname: str, first_name: str) -> bool:
-        try:
-            cursor = self.db.cursor()
-            cursor.execute("INSERT IGNORE INTO Users(UserID,Nickname,FirstName)VALUE(%s,%s,%s);", (user_id, nickname, first_name))
-            self.db.commit()
-            return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot add user {user_id} with nickname {nickname} and first name {first_name}: {e}')
-            return False
+    def split_message(self, message: str) -> list:
+        # lowered words of message without links
+        return self.tokenizer.tokenize(message)
 
-    def add_words(self, words: list) -> bool:
-        try:
-            cursor = self.db.cursor()
-            values = ','.join([f"({hash(word)},'{word}')" for word in words])
-            cursor.execute(f"INSERT INTO Words(WordID,Word)VALUES{values} ON DUPLICATE KEY UPDATE WordID=WordID;")
-            self.db.commit()
-            return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot add words {words}: {e}')
-            return False
 
-    def add_message(self, message_id: int, date: datetime, chat_id: int, user_id: int) -> bool:
-        try:
-            cursor = self.db.cursor()
-            # insert message
-            cursor.execute("INSERT INTO Messages(MessageID,Date,ChatID,UserID)VALUE(%s,%s,%s,%s);", (message_id, date, chat_id, user_id))
-            self.db.commit()
+    # region adding messages
+    async def add_user(self, user_id: int, nickname: str, first_name: str) -> bool:
+        # write only new users and changed profiles
+        if self.users_cache.get(user_id) == (nickname, first_name):
             return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot add message on {date} for chat {chat_id} for user {user_id}: {e}')
-            return False
 
-    def delete_message(self, message_id: int):
-        try:
-            cursor = self.db.cursor()
-            cursor.execute("DELETE IGNORE FROM Messages WHERE MessageID=%s;", (message_id,))
-            self.db.commit()
+        if self.buffer is not None:
+            # buffered users are cached once their batch is written, until then every batch of their messages has them
+            self.buffer.add_user(user_id, nickname, first_name)
             return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot delete message {message_id}: {e}')
+        if not await self.db.run(self.db.add_user, user_id, nickname, first_name):
             return False
+        self.users_cache.set(user_id, (nickname, first_name))
+        return True
 
-    def add_message_with_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, message: str) -> bool:
+    async def add_message_with_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, message: str, reply_to: int = None) -> bool:
         # split message to words
         words = self.split_message(message)
+        # messages without words are kept too, so their edits can be applied
+        self.heavy_hitters.add_words(message_id, date, chat_id, user_id, words)
         if (len(words) == 0):
             return False
 
-        if (not self.add_message(message_id, date, chat_id, user_id)):
-            return False
-
-        # try adding words to database
-        self.add_words(words)
-
-        # add words to message
-        try:
-            cursor = self.db.cursor()
-            values = ','.join([f'({message_id},{hash(word)})' for word in words])
-            cursor.execute(f"INSERT INTO Messages_Words(MessageID,WordID)VALUES{values};")
-            self.db.commit()
-            return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot add message {message_id} on {date} for chat {chat_id}, user {user_id} and words {words}: {e}')
-            return False
-
-    def add_message_with_gif(self, message_id: int, date: datetime, chat_id: int, user_id: int, gif_unique_id: str, gif_id: str, duration: int, height: int, width: int) -> bool:
-        if (not self.add_message(message_id, date, chat_id, user_id)):
-            return False
-        try:
-            cursor = self.db.cursor()
-            # insert message
-            cursor.execute("INSERT IGNORE INTO Gifs(GifUniqueID,MessageID,GifID,Duration,Height,Width)VALUE(%s,%s,%s,%s,%s,%s);", (gif_unique_id, message_id, gif_id, duration, height, width))
-            self.db.commit()
-            return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot add message {message_id} on {date} for chat {chat_id} for user {user_id} with gif {gif_unique_id}: {e}')
-            return False
+        if self.buffer is not None:
+            self.buffer.add_message_with_words(message_id, date, chat_id, user_id, words, reply_to)
+            return await self.flush_buffer_if_full()
+        return self.invalidate_stats(chat_id, date, self.count_stored('words', await self.db.run(self.db.add_message_with_words, message_id, date, chat_id, user_id, words, reply_to)))
 
-    def add_message_with_sticker(self, message_id: int, date: datetime, chat_id: int, user_id: int, sticker_unique_id: str, sticker_set_name: str) -> bool:
-        if (not self.add_message(message_id, date, chat_id, user_id)):
-            return False
-        try:
-            cursor = self.db.cursor()
-            # insert message
-            cursor.execute("INSERT IGNORE INTO Stickers(StickerUniqueID,MessageID,StickerSetName)VALUE(%s,%s,%s);", (sticker_unique_id, message_id, sticker_set_name))
-            self.db.commit()
+    async def edit_message_with_words(self, message_id: int, date: datetime, chat_id: int, user_id: int, message: str, reply_to: int = None) -> bool:
+        words = self.split_message(message)
+        self.heavy_hitters.edit_words(message_id, date, chat_id, user_id, words)
+        if self.buffer is not None:
+            # messages that are not written yet are edited in the buffer
+            if self.buffer.replace_words(chat_id, message_id, words):
+                return True
+            # the message may be in the batch that is being written, then its flush is waited for without starting a new one
+            if (chat_id, message_id) in self.writing:
+                async with self.buffer_lock:
+                    pass
+                # a batch that was not written is back in the buffer
+                if self.buffer.replace_words(chat_id, message_id, words):
+                    return True
+        return self.invalidate_stats(chat_id, date, self.count_stored('edits', await self.db.run(self.db.edit_message_with_words, message_id, date, chat_id, user_id, words, reply_to)))
+
+    async def add_message_with_gif(self, message_id: int, date: datetime, chat_id: int, user_id: int, gif_unique_id: str, gif_id: str, duration: int, height: int, width: int, reply_to: int = None) -> bool:
+        if self.buffer is not None:
+            self.buffer.add_message_with_gif(message_id, date, chat_id, user_id, gif_unique_id, gif_id, duration, height, width, reply_to)
+            return await self.flush_buffer_if_full()
+        return self.invalidate_stats(chat_id, date, self.count_stored('gifs', await self.db.run(self.db.add_message_with_gif, message_id, date, chat_id, user_id, gif_unique_id, gif_id, duration, height, width, reply_to)))
+
+    async def add_message_with_sticker(self, message_id: int, date: datetime, chat_id: int, user_id: int, sticker_unique_id: str, sticker_set_name: str, reply_to: int = None) -> bool:
+        self.heavy_hitters.add_sticker(date, chat_id, user_id, sticker_unique_id, sticker_set_name)
+        if self.buffer is not None:
+            self.buffer.add_message_with_sticker(message_id, date, chat_id, user_id, sticker_unique_id, sticker_set_name, reply_to)
+            return await self.flush_buffer_if_full()
+        return self.invalidate_stats(chat_id, date, self.count_stored('stickers', await self.db.run(self.db.add_message_with_sticker, message_id, date, chat_id, user_id, sticker_unique_id, sticker_set_name, reply_to)))
+
+    async def flush_buffer(self) -> bool:
+        # flushes are serialized, so once this returns every message queued before is stored
+        async with self.buffer_lock:
+            if self.buffer is None:
+                return True
+            # updates processed so far have their messages in the batch that is written now
+            unacknowledged = self.unacknowledged
+            self.unacknowledged = []
+            if len(self.buffer) == 0 and len(self.buffer.batch.users) == 0:
+                self.acknowledge(unacknowledged)
+                return True
+            batch = self.buffer.take()
+            self.writing = {(message[2], message[0]) for message in batch.messages}
+            try:
+                stored = await self.db.run(self.db.add_batch, batch)
+            finally:
+                self.writing = set()
+            if not stored:
+                # written again with the next flush
+                if self.buffer.put_back(batch):
+                    self.unacknowledged = unacknowledged + self.unacknowledged
+                else:
+                    print(datetime.now(), f'Dropping {len(batch)} buffered messages after {batch.failures} failed flushes')
+                    self.acknowledge(unacknowledged)
+                return False
+            self.acknowledge(unacknowledged)
+            for user_id, nickname, first_name in batch.users.values():
+                self.users_cache.set(user_id, (nickname, first_name))
+            messages_stored.inc('words', amount=len(batch.words))
+            messages_stored.inc('gifs', amount=len(batch.gifs))
+            messages_stored.inc('stickers', amount=len(batch.stickers))
+            # kept results of ended windows are deleted with one query for the whole batch
+            closed = set()
+            for message_id, date, chat_id, user_id, reply_to in batch.messages:
+                self.invalidate_stats(chat_id, date, True, closed)
+            if len(closed) > 0:
+                self.delete_closed_stats(list(closed))
             return True
-        except Exception as e:
-            print(datetime.now(), f'Cannot add message {message_id} on {date} for chat {chat_id} for user {user_id} with sticker {sticker_unique_id}: {e}')
-            return False
-
-    def get_settings(self, chat_id: int):
-        try:
-            cursor = self.db.cursor()
-            cursor.execute('SELECT IgnoreTextFromPhoto,IgnoreTextFromVideo,IgnoreTextFromDocument,IgnoreGif,IgnoreStickers,IgnoreChannelPosts FROM Settings WHERE ChatID=%s;', (chat_id,))
-            result = cursor.fetchall()
-            return result
-        except Exception as e:
-            print(datetime.now(), f'Cannot get settings for chat {chat_id}: {e}')
-            return None
-
-    def get_user_num(self, chat_id: int):
-        try:
-            cursor = self.db.cursor()
-            cursor.execute('SELECT COUNT(DISTINCT UserID) FROM Messages WHERE ChatID=%s;', (chat_id,))
-            result = cursor.fetchone()
-            return result[0]
-        except Exception as e:
-            print(datetime.now(), f'Cannot get users num for chat {chat_id}: {e}')
-            return None
 
-    def get_users(self, chat_id: int, num: int, offset: int):
-        try:
-            cursor = self.db.cursor()
-            cursor.execute('SELECT u.UserID,u.Nickname,u.FirstName FROM Users u JOIN(SELECT DISTINCT UserID FROM Messages WHERE ChatID=%s) t ON t.UserId=u.UserID ORDER BY u.FirstName DESC LIMIT %s OFFSET %s;', (chat_id,num, offset))
-            result = cursor.fetchall()
-            return result
-        except Exception as e:
-            print(datetime.now(), f'Cannot get {num} users for chat {chat_id} with offset {offset}: {e}')
-            return None
-    # endregion
+    def acknowledge(self, update_ids: list):
+        if self.acks is not None:
+            for update_id in update_ids:
+                self.acks.put((self.shard[0], update_id))
 
-    # region statistics
-    def get_stats_for_words(self, chat_id: int, user_id: int, start: datetime, end: datetime):
-        try:
-            cursor = self.db.cursor()
-            if user_id is None:
-                cursor.execute('SELECT w.Word,COUNT(*) FROM Messages m JOIN Messages_Words mw ON m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID WHERE m.ChatID=%s AND m.Date>=%s AND m.Date<=%s GROUP BY w.WordID ORDER BY 2 DESC LIMIT 20;', (chat_id,start,end))
-            else:
-                cursor.execute('SELECT w.Word,COUNT(*) FROM Messages m JOIN Messages_Words mw ON m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID WHERE m.ChatID=%s AND m.UserID=%s AND m.Date>=%s AND m.Date<=%s GROUP BY w.WordID ORDER BY 2 DESC LIMIT 20;', (chat_id,user_id,start,end))
-            result = cursor.fetchall()
-            return result
-        except Exception as e:
-            print(datetime.now(), f'Cannot get stats for words for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
-            return None
-
-    def get_stats_for_characters(self, chat_id: int, user_id: int, start: datetime, end: datetime):
-        try:
-            cursor = self.db.cursor()
-            if user_id is None:
-                cursor.execute('SELECT SUM(CHAR_LENGTH(w.Word)) FROM Messages m JOIN Messages_Words mw ON m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID WHERE m.ChatID=%s AND m.Date>=%s AND m.Date<=%s;', (chat_id,start,end))
-            else:
-                cursor.execute('SELECT SUM(CHAR_LENGTH(w.Word)) FROM Messages m JOIN Messages_Words mw ON m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID WHERE m.ChatID=%s AND m.UserID=%s AND m.Date>=%s AND m.Date<=%s;', (chat_id,user_id,start,end))
-            result = cursor.fetchone()[0]
-            return result
-        except Exception as e:
-            print(datetime.now(), f'Cannot get stats for characters for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
-            return None
+    async def flush_buffer_if_full(self) -> bool:
+        if self.buffer.is_full():
+            return await self.flush_buffer()
+        return True
 
-    def get_stats_for_gif(self, chat_id: int, user_id: int, start: datetime, end: datetime):
-        try:
-            cursor = self.db.cursor()
-            if user_id is None:
-                cursor.execute('SELECT GifCount,GifUniqueID,GifID,Duration,Height,Width FROM(SELECT g.*,ROW_NUMBER()OVER(PARTITION BY GifUniqueID ORDER BY MessageID) AS row_num,GifCount FROM Gifs g INNER JOIN(SELECT GifUniqueID,COUNT(*) AS GifCount FROM Gifs g JOIN Messages m ON g.MessageID=m.MessageID WHERE m.ChatID=%s AND m.Date>=%s AND m.Date<=%s  GROUP BY GifUniqueID ORDER BY GifCount DESC LIMIT 3)TopGifs ON G.GifUniqueID=TopGifs.GifUniqueID)g WHERE g.row_num=1 ORDER BY GifCount DESC;', (chat_id,start,end))
-            else:
-                cursor.execute('SELECT GifCount,GifUniqueID,GifID,Duration,Height,Width FROM(SELECT g.*,ROW_NUMBER()OVER(PARTITION BY GifUniqueID ORDER BY MessageID) AS row_num,GifCount FROM Gifs g INNER JOIN(SELECT GifUniqueID,COUNT(*) AS GifCount FROM Gifs g JOIN Messages m ON g.MessageID=m.MessageID WHERE m.ChatID=%s AND m.UserID=%s AND m.Date>=%s AND m.Date<=%s GROUP BY GifUniqueID ORDER BY GifCount DESC LIMIT 3)TopGifs ON G.GifUniqueID=TopGifs.GifUniqueID)g WHERE g.row_num=1 ORDER BY GifCount DESC;', (chat_id,user_id,start,end))
-            result = cursor.fetchall()
-            return result
-        except Exception as e:
-            print(datetime.now(), f'Cannot get stats for gifs for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
-            return None
+    def invalidate_stats(self, chat_id: int, date: datetime, stored: bool, closed: set = None) -> bool:
+        # cached statistics that include a stored message are outdated,
+        # kept results of ended windows are deleted now, or their (chat id, day) is added to closed to delete them later
+        if stored:
+            date = None if date is None else date.replace(tzinfo=None)
+            self.stats_cache.invalidate(chat_id, date)
+            # only messages sent before today are in windows that ended
+            today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            if date is None or date < today:
+                # ended windows start and end at midnight, so the start of the day is in every window of its messages
+                key = (chat_id, None if date is None else date.replace(hour=0, minute=0, second=0, microsecond=0))
+                if closed is None:
+                    self.delete_closed_stats([key])
+                else:
+                    closed.add(key)
+        return stored
 
-    def get_stats_for_sticker(self, chat_id: int, user_id: int, start: datetime, end: datetime):
-        try:
-            cursor = self.db.cursor()
-            if user_id is None:
-                cursor.execute('SELECT StickerUniqueID,StickerSetName,COUNT(*) FROM Stickers s JOIN Messages m ON s.MessageID=m.MessageID WHERE m.ChatID=%s AND m.Date>=%s AND m.Date<=%s GROUP BY StickerUniqueID,StickerSetName ORDER BY 3 DESC LIMIT 3;', (chat_id, start, end))
-            else:
-                cursor.execute('SELECT StickerUniqueID,StickerSetName,COUNT(*) FROM Stickers s JOIN Messages m ON s.MessageID=m.MessageID WHERE m.ChatID=%s AND m.UserID=%s AND m.Date>=%s AND m.Date<=%s GROUP BY StickerUniqueID,StickerSetName ORDER BY 3 DESC LIMIT 3;', (chat_id, user_id, start, end))
-            result = cursor.fetchall()
-            return result
-        except Exception as e:
-            print(datetime.now(), f'Cannot get stats for stickers for chat {chat_id}, user {user_id} before {start} and {end}: {e}')
-            return None
+    def delete_closed_stats(self, chat_dates: list):
+        task = asyncio.create_task(self.db.run(self.db.delete_closed_stats, chat_dates))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
     # endregion
 
 
@@ -283,6 +490,107 @@ class Bot:
 
     async def error(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         print(datetime.now(), f'Update {update} caused error {context.error}')
+
+    async def flush_buffer_job(self, context: ContextTypes.DEFAULT_TYPE):
+        await self.flush_buffer()
+
+    async def compact_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # deletes raw messages in small batches with pauses, so live updates get database workers in between
+        # kept statistics of closed windows that are not shown anymore, e.g. of the day before yesterday, are deleted first
+        deleted = await self.db.run(self.db.delete_old_closed_stats, [self.get_time(time) for time in self.closed_windows])
+        if deleted:
+            print(datetime.now(), f'Deleted {deleted} statistics of old closed windows')
+        chats = await self.db.run(self.db.get_retention, self.retention_days)
+        if chats is None:
+            return
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        for chat_id, days in chats:
+            if self.shard is not None and chat_shard(chat_id, self.shard[1]) != self.shard[0]:
+                continue
+            # whole days are deleted, they stay in the daily rollups
+            before = today - timedelta(days=max(days, self.min_retention_days))
+            if not await self.db.run(self.db.set_compacted_before, chat_id, before):
+                continue
+            deleted = 0
+            while True:
+                count = await self.db.run(self.db.compact_messages, chat_id, before, self.retention_batch_size)
+                if count is None:
+                    break
+                deleted += count
+                if count < self.retention_batch_size:
+                    break
+                await asyncio.sleep(self.retention_pause)
+            if deleted > 0:
+                print(datetime.now(), f'Deleted {deleted} messages of chat {chat_id} sent before {before}')
+
+    async def precompute_job(self, context: ContextTypes.DEFAULT_TYPE):
+        # computes statistics of windows that ended at midnight for chats active during them,
+        # one query at a time and only while database workers are not busy, so live updates are not delayed
+        today = datetime.utcnow()
+        times = ['prev-day']
+        if today.weekday() == 0:
+            times.append('prev-week')
+        if today.day == 1:
+            times.append('prev-month')
+            if today.month == 1:
+                times.append('prev-year')
+        chats = await self.db.run(self.db.get_active_chats, self.get_time(times[-1])[0])
+        if chats is None:
+            return
+        if self.shard is not None:
+            chats = [chat_id for chat_id in chats if chat_shard(chat_id, self.shard[1]) == self.shard[0]]
+        busy = max(self.db.pool_size // 2, 1)
+        computed = 0
+        for chat_id in chats:
+            for window in times:
+                for type in ('word', 'char', 'gif', 'sticker'):
+                    while queries_in_flight.values.get((), 0) >= busy:
+                        await asyncio.sleep(self.precompute_pause)
+                    if await self.get_stats(type, chat_id, None, window) is not None:
+                        computed += 1
+                    await asyncio.sleep(self.precompute_pause)
+        print(datetime.now(), f"Computed {computed} statistics of {', '.join(times)} for {len(chats)} chats")
+        if self.weekly_digest and 'prev-week' in times:
+            for chat_id in chats:
+                try:
+                    await context.bot.send_message(chat_id, await self.get_user_report(chat_id, None, 'the chat', 'prev-week'))
+                except Exception as e:
+                    print(datetime.now(), f'Cannot send weekly digest to chat {chat_id}: {e}')
+                await asyncio.sleep(self.precompute_pause)
+
+    async def save_heavy_hitters_job(self, context: ContextTypes.DEFAULT_TYPE):
+        self.heavy_hitters.expire()
+        snapshot = self.heavy_hitters.snapshot(False)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.heavy_hitters.save, snapshot)
+        except Exception as e:
+            print(datetime.now(), f'Cannot save top words and stickers sketches: {e}')
+
+    async def post_init(self, app: Application):
+        self.lag_probe = asyncio.create_task(self.probe_event_loop_lag())
+        # prometheus endpoint is served only when a port is set
+        metrics_port = os.getenv('words_stats_bot_metrics_port')
+        if metrics_port:
+            # every worker serves its own metrics on the next ports
+            metrics_port = int(metrics_port) + (0 if self.shard is None else self.shard[0])
+            self.metrics_server = await asyncio.start_server(self.serve_metrics, os.getenv('words_stats_bot_metrics_host', '127.0.0.1'), metrics_port)
+            print(datetime.now(), f'Serving metrics on port {metrics_port}')
+
+    async def post_stop(self, app: Application):
+        # runs after polling stopped (including on SIGTERM), so nothing else is added to the buffer
+        if self.buffer is not None:
+            print(datetime.now(), f'Flushing {len(self.buffer)} buffered messages')
+            await self.flush_buffer()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.heavy_hitters.save, self.heavy_hitters.snapshot(True))
+        except Exception as e:
+            print(datetime.now(), f'Cannot save top words and stickers sketches: {e}')
+        if self.lag_probe is not None:
+            self.lag_probe.cancel()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.db.close()
     # endregion
 
     # region commands
@@ -292,7 +600,116 @@ class Bot:
         if update.message.from_user.id == self.admin_id and message_from.total_seconds() / 60 < 1:
             await update.message.reply_text('Shutting down')
             print(datetime.now(), 'Shutting down')
-            os.kill(os.getpid(), 15)
+            await self.flush_buffer()
+            # a worker stops the front process, which stops all workers
+            os.kill(os.getpid() if self.shard is None else os.getppid(), 15)
+
+    async def import_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # /import <path to result.json of telegram desktop export> [chat id], only for admin as it reads files of the server
+        if update.message.from_user.id != self.admin_id:
+            return
+        if len(context.args) == 0:
+            await update.message.reply_text('Usage: /import <path to result.json> [chat id]')
+            return
+        chat_id = int(context.args[1]) if len(context.args) > 1 else None
+        # import runs in background, so updates are processed meanwhile
+        context.application.create_task(self.import_history(update.message, context.args[0], chat_id))
+        await update.message.reply_text(f'Importing {context.args[0]}')
+
+    async def metrics_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # only for admin as metrics cover all chats
+        if update.message.from_user.id != self.admin_id:
+            return
+        # many handlers and queries do not fit into one message
+        for part in self.split_text(self.get_metrics_summary()):
+            await update.message.reply_text(part)
+
+    async def retention_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # /retention <days|default> [chat id], 0 days keeps messages of the chat forever
+        if update.message.from_user.id != self.admin_id:
+            return
+        if len(context.args) == 0 or not (context.args[0] == 'default' or context.args[0].isdigit()):
+            await update.message.reply_text('Usage: /retention <days|default> [chat id]')
+            return
+        chat_id = int(context.args[1]) if len(context.args) > 1 else update.message.chat_id
+        days = None if context.args[0] == 'default' else int(context.args[0])
+        if not await self.db.run(self.db.set_retention, chat_id, days):
+            await update.message.reply_text(f'Cannot set retention of chat {chat_id}')
+            return
+        days = self.retention_days if days is None else days
+        if days is None or days == 0:
+            await update.message.reply_text(f'Messages of chat {chat_id} are kept forever')
+        else:
+            await update.message.reply_text(f'Messages of chat {chat_id} are kept for {max(days, self.min_retention_days)} days, statistics are kept forever')
+
+    async def export_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        # /export <words|users|gifs|stickers> [time] [csv|jsonl], full statistics of the chat for its administrators
+        if not await self.is_chat_admin(update.message, context):
+            return
+        type = context.args[0] if len(context.args) > 0 else None
+        time = context.args[1] if len(context.args) > 1 else 'all'
+        format = context.args[2] if len(context.args) > 2 else 'csv'
+        if type not in self.export_types or time not in self.stats_cache_windows or format not in ExportFile.formats:
+            await update.message.reply_text(f"Usage: /export <{'|'.join(self.export_types)}> [time] [{'|'.join(ExportFile.formats)}], time is one of {', '.join(self.stats_cache_windows)}")
+            return
+        if self.export_lock.locked():
+            await update.message.reply_text('Another export is running, try again later')
+            return
+        # export runs in background, so updates are processed meanwhile
+        context.application.create_task(self.export_stats(update.message, type, time, format))
+        await update.message.reply_text(f'Exporting {type} during {self.get_desc_time(time)}')
+
+    async def is_chat_admin(self, message: Message, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        if message.from_user.id == self.admin_id or message.chat.type == ChatType.PRIVATE:
+            return True
+        try:
+            member = await context.bot.get_chat_member(message.chat_id, message.from_user.id)
+        except Exception as e:
+            print(datetime.now(), f'Cannot get member {message.from_user.id} of chat {message.chat_id}: {e}')
+            return False
+        return member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+    async def export_stats(self, message: Message, type: str, time: str, format: str):
+        async with self.export_lock:
+            # buffered messages are included
+            await self.flush_buffer()
+            start, end = self.get_time(time)
+            descriptor, path = tempfile.mkstemp(suffix=f'.{format}.gz')
+            os.close(descriptor)
+            try:
+                file = ExportFile(path, format)
+                loop = asyncio.get_running_loop()
+                try:
+                    # rows are read and compressed in a thread with its own connection
+                    count = await loop.run_in_executor(None, self.db.export_stats, type, message.chat_id, start, end, file.header, file.write)
+                finally:
+                    await loop.run_in_executor(None, file.close)
+                if count is None:
+                    await message.reply_text(f'Cannot export {type}')
+                elif os.path.getsize(path) > self.max_export_size:
+                    await message.reply_text(f'Export of {count} {type} is larger than 50 MB, choose a shorter time')
+                else:
+                    with open(path, 'rb') as document:
+                        await message.reply_document(document, filename=f'{type}-{time}.{format}.gz', caption=f'{count} {type} during {self.get_desc_time(time)}')
+            except Exception as e:
+                print(datetime.now(), f'Cannot send export of {type} to chat {message.chat_id}: {e}')
+            finally:
+                os.remove(path)
+
+    async def import_history(self, message: Message, path: str, chat_id: int):
+        importer = HistoryImporter(self.db, self.tokenizer, int(os.getenv('words_stats_bot_import_batch_size', 10000)))
+        try:
+            await importer.run(path, chat_id)
+            result = f'Imported {importer.imported} messages into chat {importer.chat_id}, skipped {importer.skipped}'
+        except Exception as e:
+            print(datetime.now(), f'Cannot import {path}: {e}')
+            result = f'Import stopped after {importer.imported} messages: {e}'
+        messages_stored.inc('imports', amount=importer.imported)
+        if importer.chat_id is not None:
+            self.invalidate_stats(importer.chat_id, None, True)
+            # imported recent messages are not in the sketches
+            self.heavy_hitters.reset(importer.chat_id)
+        await message.reply_text(result)
 
     async def process_new_group_members(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # get new user
@@ -300,14 +717,25 @@ class Bot:
         # check if username of new user is bot and it 
         if self.bot_username == chat_member.new_chat_member.user.username:
             if chat_member.new_chat_member.status == ChatMemberStatus.ADMINISTRATOR or chat_member.new_chat_member.status == ChatMemberStatus.MEMBER:
-                self.create_settings(update._effective_chat.id)
+                await self.db.run(self.db.create_settings, update._effective_chat.id)
+                self.settings_cache.delete(update._effective_chat.id)
             elif chat_member.new_chat_member.status == ChatMemberStatus.LEFT or chat_member.new_chat_member.status == ChatMemberStatus.BANNED:
-                self.delete_settings(update._effective_chat.id)
-
-    def validate_settings(self, message: Message) -> bool:
+                if await self.db.run(self.db.delete_settings, update._effective_chat.id):
+                    self.settings_cache.set(update._effective_chat.id, [])
+
+    async def get_settings(self, chat_id: int):
+        settings = self.settings_cache.get(chat_id)
+        if settings is None:
+            settings = await self.db.run(self.db.get_settings, chat_id)
+            # failed lookups are not cached, missing settings are
+            if settings is not None:
+                self.settings_cache.set(chat_id, settings)
+        return settings
+
+    async def validate_settings(self, message: Message) -> bool:
         # get settings
-        settings = self.get_settings(message.chat_id)
-        if (settings is None):
+        settings = await self.get_settings(message.chat_id)
+        if (settings is None or len(settings) == 0):
             return False
         settings = settings[0]
 
@@ -341,60 +769,67 @@ class Bot:
 
         return True
 
+    def get_reply_to(self, message: Message) -> int:
+        # messages of forum topics reply to the message that created the topic, which is not a reply of the user
+        reply = message.reply_to_message
+        if reply is None or reply.forum_topic_created is not None:
+            return None
+        return reply.message_id
+
     async def process_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if (update.message):
-            if (not self.validate_settings(update.message)):
+            if (not await self.validate_settings(update.message)):
                 return
 
             # try adding user
-            self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
+            await self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
 
             # save words in message to database
-            self.add_message_with_words(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.text)
+            await self.add_message_with_words(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.text, self.get_reply_to(update.message))
         elif (update.edited_message):
-            if (not self.validate_settings(update.edited_message)):
+            if (not await self.validate_settings(update.edited_message)):
                 return
 
             # try adding user
-            self.add_user(update.edited_message.from_user.id, update.edited_message.from_user.username, update.edited_message.from_user.first_name)
+            await self.add_user(update.edited_message.from_user.id, update.edited_message.from_user.username, update.edited_message.from_user.first_name)
             
-            # delete message
-            self.delete_message(update.edited_message.message_id)
-            # save words in message to database
-            self.add_message_with_words(update.edited_message.message_id, update.edited_message.edit_date, update.edited_message.chat_id, update.edited_message.from_user.id, update.edited_message.text)
+            # apply changed words, date of edited message is the date it was sent
+            await self.edit_message_with_words(update.edited_message.message_id, update.edited_message.date, update.edited_message.chat_id, update.edited_message.from_user.id, update.edited_message.text,
+                                               self.get_reply_to(update.edited_message))
 
     async def process_photo_video_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if (not self.validate_settings(update.message)):
+        if (not await self.validate_settings(update.message)):
             return
 
         # try adding user
-        self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
+        await self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
 
         # save words in message to database
-        self.add_message_with_words(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.caption)
+        await self.add_message_with_words(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.caption, self.get_reply_to(update.message))
 
     async def process_gif(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if (not self.validate_settings(update.message)):
+        if (not await self.validate_settings(update.message)):
             return
 
         # try adding user
-        self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
+        await self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
 
         # save gif in message to database
-        self.add_message_with_gif(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.animation.file_unique_id,
-                                  update.message.animation.file_id, update.message.animation.duration, update.message.animation.height, update.message.animation.width)
+        await self.add_message_with_gif(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.animation.file_unique_id,
+                                  update.message.animation.file_id, update.message.animation.duration, update.message.animation.height, update.message.animation.width, self.get_reply_to(update.message))
 
         # await self.download_gif(update.message.animation.file_id, update.message.animation.file_unique_id)
 
     async def process_sticker(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if (not self.validate_settings(update.message)):
+        if (not await self.validate_settings(update.message)):
             return
 
         # try adding user
-        self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
+        await self.add_user(update.message.from_user.id, update.message.from_user.username, update.message.from_user.first_name)
 
         # save words in message to database
-        self.add_message_with_sticker(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.sticker.file_unique_id, update.message.sticker.set_name)
+        await self.add_message_with_sticker(update.message.id, update.message.date, update.message.chat_id, update.message.from_user.id, update.message.sticker.file_unique_id, update.message.sticker.set_name,
+                                            self.get_reply_to(update.message))
     # endregion
 
     # region stat commands
@@ -448,9 +883,91 @@ class Bot:
             return (datetime.utcnow() - relativedelta(hour=0, minute=0, second=0, microsecond=0), datetime.max)
 
 
+    def get_stats_window(self, time: str) -> tuple:
+        start, end = self.get_time(time)
+        rounding = self.stats_cache_windows[time][0]
+        if rounding is not None:
+            # round sliding windows so close requests share cached results, they are open ended as nothing is stored after now
+            start = datetime.min + (start - datetime.min) // rounding * rounding
+            end = datetime.max
+        return (start, end)
+
+    def get_stats_limit(self, type: str) -> int:
+        if type == 'word': return self.top_words
+        elif type in ('gif', 'sticker'): return self.top_media
+
+    async def get_stats(self, type: str, chat_id: int, user, time: str):
+        start, end = self.get_stats_window(time)
+        limit = self.get_stats_limit(type)
+        if time in ('last-day', 'this-day') and type in ('word', 'sticker'):
+            # answered from memory when the sketches cover the window
+            top = self.heavy_hitters.top(chat_id, user, type, start, end, self.get_stats_limit(type))
+            if top is not None:
+                return top[0] if type == 'word' else [item + (count,) for item, count in top[0]]
+        key = (chat_id, user, type, start, end)
+        result = self.stats_cache.get(key)
+        if result is None and time in self.closed_windows:
+            rows = await self.db.run(self.db.get_closed_stats, chat_id, user, type, start, end)
+            if rows:
+                # kept results are used when they have at least as many rows as shown now,
+                # results kept without their limit are computed again
+                kept = json.loads(rows[0][0])
+                if isinstance(kept, dict) and 'result' in kept and (limit is None or (kept.get('limit') or 0) >= limit):
+                    result = kept['result'] if limit is None else kept['result'][:limit]
+                    self.stats_cache.set(key, result, self.stats_cache_windows[time][1])
+        if result is None:
+            if type == 'word': query = self.db.get_stats_for_words
+            elif type == 'char': query = self.db.get_stats_for_characters
+            elif type == 'gif': query = self.db.get_stats_for_gif
+            elif type == 'sticker': query = self.db.get_stats_for_sticker
+            elif type == 'activity': query = self.db.get_stats_for_activity
+            result = await self.db.run_stats(query, chat_id, user, start, end, *(() if limit is None else (limit,)))
+            if result is not None:
+                self.stats_cache.set(key, result, self.stats_cache_windows[time][1])
+                if time in self.closed_windows:
+                    # sums are decimals in mysql
+                    await self.db.run(self.db.set_closed_stats, chat_id, user, type, start, end, json.dumps({'limit': limit, 'result': result}, default=int))
+        return result
+
     async def get_stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await self.show_buttons_for_type_selection(update, True)
 
+    async def user_report_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # /me [time] reports the sender, /userstats [time] sent as a reply reports the author of the replied message
+        time = context.args[0] if len(context.args) > 0 else 'all'
+        if time not in self.stats_cache_windows:
+            await update.message.reply_text(f"Usage: /me [time] or /userstats [time] as a reply, time is one of {', '.join(self.stats_cache_windows)}")
+            return
+        if update.message.text.startswith('/me'):
+            user = update.message.from_user
+        elif self.get_reply_to(update.message) is not None and update.message.reply_to_message.from_user is not None:
+            user = update.message.reply_to_message.from_user
+        else:
+            await update.message.reply_text('Reply with /userstats to a message of the user')
+            return
+        await update.message.reply_text(await self.get_user_report(update.message.chat_id, user.id, user.first_name, time))
+
+    async def get_user_report(self, chat_id: int, user_id: int, user_name: str, time: str) -> str:
+        # all statistics are queried at the same time on the stats pool, so the report takes as long as the slowest query,
+        # see benchmarks/report_benchmark.py
+        words, characters, gifs, stickers, activity = await asyncio.gather(*[self.get_stats(type, chat_id, user_id, time) for type in ('word', 'char', 'gif', 'sticker', 'activity')])
+        lines = [f'Statistics of {user_name} during {self.get_desc_time(time)}:', '']
+        if activity is None:
+            lines.append('Messages: unknown')
+        else:
+            lines.append(f'Messages: {sum([hour[1] for hour in activity])}, replies: {sum([hour[2] for hour in activity])}')
+            hours = sorted(activity, key=lambda hour: -hour[1])[:3]
+            if len(hours) > 0:
+                lines.append('Most active hours (UTC): ' + ', '.join([f'{hour[0]}:00 ({hour[1]} messages)' for hour in hours]))
+        lines.append(f"Characters: {'unknown' if characters is None else characters or 0}")
+        if words:
+            lines.append('Top words: ' + ', '.join([f'{word[0]} ({word[1]})' for word in words[:10]]))
+        if gifs:
+            lines.append('Top gifs used ' + ', '.join([str(gif[0]) for gif in gifs]) + ' times')
+        if stickers:
+            lines.append('Top stickers: ' + ', '.join([f'{sticker[1]} ({sticker[2]})' for sticker in stickers]))
+        return '\n'.join(lines)
+
     async def get_stats_buttons(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         query = update.callback_query
         responses = query.data.split('|')
@@ -511,28 +1028,40 @@ class Bot:
     async def show_buttons_for_entity_selection(self, update: Update, type: str, time: str) -> None:
         state_entity = [
             [InlineKeyboardButton("All", callback_data=f"{type}|{time}|all")],
-            [InlineKeyboardButton("User", callback_data=f"{type}|{time}|page_0")],
+            [InlineKeyboardButton("User", callback_data=f"{type}|{time}|page")],
             [InlineKeyboardButton("< Back", callback_data=f"{type}")]
         ]
         await update.callback_query.edit_message_text(text=f"Get top {self.get_desc_type(type)} during {self.get_desc_time(time)} for:", reply_markup=InlineKeyboardMarkup(state_entity))
 
     async def show_buttons_for_user_selection(self, update: Update, type: str, time: str, user: str) -> None:
+        # users are sorted by number of messages, 'page' is the first page, 'next_<messages>_<user id>' and 'prev_<messages>_<user id>'
+        # continue after the last or before the first user of the page they were shown on
         users_per_page = 10
-        page = int(user.split('_')[1])
-        offset = page * users_per_page
-
-        users = self.get_users(update.callback_query.message.chat_id, users_per_page, offset)
-        users_num = self.get_user_num(update.callback_query.message.chat_id)
+        page = user.split('_')
+        after = (int(page[1]), int(page[2])) if page[0] == 'next' else None
+        before = (int(page[1]), int(page[2])) if page[0] == 'prev' else None
+
+        # one more user tells whether there is a page further in the same direction
+        users = await self.db.run(self.db.get_users, update.callback_query.message.chat_id, users_per_page + 1, after, before)
+        if users is None:
+            users = []
+        more = len(users) > users_per_page
+        if before is not None:
+            users = users[len(users) - users_per_page:] if more else users
+        else:
+            users = users[:users_per_page]
+        has_prev = more if before is not None else after is not None
+        has_next = more if before is None else True
 
         state_user = [
             [InlineKeyboardButton(user[2], callback_data=f"{type}|{time}|user_{user[0]}_{user[2]}")] for user in users
         ]
 
         state_user_pages = []
-        if page != 0:
-            state_user_pages.append(InlineKeyboardButton("<", callback_data=f"{type}|{time}|page_{page - 1}"))
-        if offset + users_per_page < users_num:
-            state_user_pages.append(InlineKeyboardButton(">", callback_data=f"{type}|{time}|page_{page + 1}"))
+        if has_prev and len(users) > 0:
+            state_user_pages.append(InlineKeyboardButton("<", callback_data=f"{type}|{time}|prev_{users[0][3]}_{users[0][0]}"))
+        if has_next and len(users) > 0:
+            state_user_pages.append(InlineKeyboardButton(">", callback_data=f"{type}|{time}|next_{users[-1][3]}_{users[-1][0]}"))
 
         if len(state_user_pages) > 0:
             state_user.append(state_user_pages)
@@ -541,6 +1070,22 @@ class Bot:
         await update.callback_query.edit_message_text(text=f"Get top {self.get_desc_type(type)} during {self.get_desc_time(time)} for:", reply_markup=InlineKeyboardMarkup(state_user))
 
 
+    async def get_gif_file_id(self, gif_id: str) -> str:
+        file_id = self.gif_files_cache.get(gif_id)
+        if file_id is None:
+            file_id = (await self.app.bot.get_file(gif_id)).file_id
+            self.gif_files_cache.set(gif_id, file_id)
+        return file_id
+
+    async def get_sticker_set(self, set_name: str) -> dict:
+        stickers = self.sticker_sets_cache.get(set_name)
+        if stickers is None:
+            sticker_set = await self.app.bot.get_sticker_set(set_name)
+            stickers = {sticker.file_unique_id: sticker for sticker in sticker_set.stickers}
+            self.sticker_sets_cache.set(set_name, stickers)
+        return stickers
+
+
     async def show_statistics(self, update: Update, type: str, time: str, user, user_name: str) -> None:
         if type == 'word':
             await self.show_statistics_for_words(update, type, time, user, user_name)
@@ -552,19 +1097,17 @@ class Bot:
             await self.show_statistics_for_stickers(update, type, time, user, user_name)
 
     async def show_statistics_for_words(self, update: Update, type: str, time: str, user, user_name: str) -> None:
-        start, end = self.get_time(time)
-        words = self.get_stats_for_words(update.callback_query.message.chat_id, user, start, end)
+        words = await self.get_stats(type, update.callback_query.message.chat_id, user, time)
         if words is None or len(words) == 0:
             await update.callback_query.edit_message_text(f"{'No one' if user_name == 'all' else user_name} has not said any word during {self.get_desc_time(time)}")
         else:
-            await update.callback_query.edit_message_text(f"Top 20 {self.get_desc_type(type)} during {self.get_desc_time(time)} for {'everyone' if user_name == 'all' else user_name} (No: word):\n\n" + 
+            await update.callback_query.edit_message_text(f"Top {self.top_words} {self.get_desc_type(type)} during {self.get_desc_time(time)} for {'everyone' if user_name == 'all' else user_name} (No: word):\n\n" + 
                                                           '\n'.join([f"{word[1]}: {word[0]}" for word in words]))
 
         await update.callback_query.answer()
 
     async def show_statistics_for_characters(self, update: Update, type: str, time: str, user, user_name: str) -> None:
-        start, end = self.get_time(time)
-        char_num = self.get_stats_for_characters(update.callback_query.message.chat_id, user, start, end)
+        char_num = await self.get_stats(type, update.callback_query.message.chat_id, user, time)
         if char_num is None or char_num == 0:
             await update.callback_query.edit_message_text(f"{'No one' if user_name == 'all' else user_name} has not said any word during {self.get_desc_time(time)}")
         else:
@@ -573,30 +1116,34 @@ class Bot:
         await update.callback_query.answer()
 
     async def show_statistics_for_gifs(self, update: Update, type: str, time: str, user, user_name: str) -> None:
-        start, end = self.get_time(time)
-        gifs = self.get_stats_for_gif(update.callback_query.message.chat_id, user, start, end)
+        gifs = await self.get_stats(type, update.callback_query.message.chat_id, user, time)
         if gifs is None or len(gifs) == 0:
             await update.callback_query.edit_message_text(f"{'No one' if user_name == 'all' else user_name} has not sent any gif during {self.get_desc_time(time)}")
         else:
-            message = await update.callback_query.edit_message_text(f"Top 3 {self.get_desc_type(type)} during {self.get_desc_time(time)} for {'everyone' if user_name == 'all' else user_name}:")
-            for gif in gifs:
-                gif_id = await self.app.bot.get_file(gif[2])
-                anim = Animation(file_unique_id=gif[1], file_id=gif_id.file_id, duration=gif[3], height=gif[4], width=gif[5])
+            # resolve all gifs while editing the message
+            message, file_ids = await asyncio.gather(update.callback_query.edit_message_text(f"Top {self.top_media} {self.get_desc_type(type)} during {self.get_desc_time(time)} for {'everyone' if user_name == 'all' else user_name}:"),
+                                                     asyncio.gather(*[self.get_gif_file_id(gif[2]) for gif in gifs]))
+            for gif, file_id in zip(gifs, file_ids):
+                anim = Animation(file_unique_id=gif[1], file_id=file_id, duration=gif[3], height=gif[4], width=gif[5])
                 await message.reply_animation(anim, caption=f'Used {gif[0]} times')
         
         await update.callback_query.answer()
 
     async def show_statistics_for_stickers(self, update: Update, type: str, time: str, user, user_name: str) -> None:
-        start, end = self.get_time(time)
-        stickers = self.get_stats_for_sticker(update.callback_query.message.chat_id, user, start, end)
+        stickers = await self.get_stats(type, update.callback_query.message.chat_id, user, time)
         if stickers is None or len(stickers) == 0:
             await update.callback_query.edit_message_text(f"{'No one' if user_name == 'all' else user_name} has not sent any sticker during {self.get_desc_time(time)}")
         else:
-            message = await update.callback_query.edit_message_text(f"Top 3 {self.get_desc_type(type)} during {self.get_desc_time(time)} for {'everyone' if user_name == 'all' else user_name}:\n\n" + '\n'.join([f'Used {stk[2]} times' for stk in stickers]))
+            # load every sticker set once while editing the message
+            set_names = list({sticker[1] for sticker in stickers})
+            message, sticker_sets = await asyncio.gather(update.callback_query.edit_message_text(f"Top {self.top_media} {self.get_desc_type(type)} during {self.get_desc_time(time)} for {'everyone' if user_name == 'all' else user_name}:\n\n" + '\n'.join([f'Used {stk[2]} times' for stk in stickers])),
+                                                         asyncio.gather(*[self.get_sticker_set(set_name) for set_name in set_names]))
+            sticker_sets = dict(zip(set_names, sticker_sets))
             for sticker in stickers:
-                sticker_set = await self.app.bot.get_sticker_set(sticker[1])
-                real_sticker = [stk for stk in sticker_set.stickers if stk.file_unique_id == sticker[0]][0]
-                await message.reply_sticker(real_sticker)
+                real_sticker = sticker_sets[sticker[1]].get(sticker[0])
+                # sticker may have been removed from its set
+                if real_sticker is not None:
+                    await message.reply_sticker(real_sticker)
 
         await update.callback_query.answer()
     # endregion
@@ -604,5 +1151,10 @@ class Bot:
 
 
 if __name__ == '__main__':
-    bot = Bot()
-    bot.start()
+    workers = int(os.getenv('words_stats_bot_workers', 1))
+    if workers > 1:
+        from workers import ShardedFront
+        ShardedFront(workers).start()
+    else:
+        bot = Bot()
+        bot.start()
@@ -0,0 +1,30 @@
+from telegram.request import BaseRequest
+from metrics import telegram_seconds
+import time
+
+
+class MeasuredRequest(BaseRequest):
+    # passes bot api requests to the wrapped request and measures them
+    request: BaseRequest
+
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE) -> tuple:
+        started = time.perf_counter()
+        try:
+            return await self.request.do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+        finally:
+            # url ends with the name of the bot api method
+            telegram_seconds.observe(time.perf_counter() - started, url.rsplit('/', 1)[-1])
@@ -0,0 +1,107 @@
+import bisect
+
+
+# metrics are updated only from the event loop thread, so they need no locks
+class Counter:
+    name: str
+    description: str
+    labels: tuple
+    values: dict
+    function: object
+
+    def __init__(self, name: str, description: str, labels: tuple = (), function=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # label values -> value
+        self.values = {}
+        # returns label values -> value when metrics are read, for values that are counted elsewhere
+        self.function = function
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> list:
+        values = self.values if self.function is None else self.function()
+        return [(self.name, label_values, (), value) for label_values, value in values.items()]
+
+
+class Gauge(Counter):
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+
+class Histogram(Counter):
+    buckets: tuple
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        # label values -> [observations per bucket and above the last one, sum, count]
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, label_values: tuple, quantile: float) -> float:
+        # upper bound of the bucket that contains the quantile
+        counts, _, count = self.values[label_values]
+        seen = 0
+        for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket
+            if seen >= quantile * count:
+                return bound
+        return float('inf')
+
+    def samples(self) -> list:
+        samples = []
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                samples.append((self.name + '_bucket', label_values, (('le', '+Inf' if bound == float('inf') else str(bound)),), cumulative))
+            samples.append((self.name + '_sum', label_values, (), total))
+            samples.append((self.name + '_count', label_values, (), count))
+        return samples
+
+
+class Registry:
+    metrics: list
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        # prometheus text format
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f"# TYPE {metric.name} {type(metric).__name__.lower()}")
+            for name, label_values, extra_labels, value in metric.samples():
+                labels = [f'{label}="{escape(value)}"' for label, value in zip(metric.labels, label_values)] + [f'{label}="{value}"' for label, value in extra_labels]
+                lines.append(f"{name}{{{','.join(labels)}}} {value}" if len(labels) > 0 else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+handler_seconds = registry.add(Histogram('words_stats_bot_handler_seconds', 'Time spent in update handlers', ('handler',)))
+handler_errors = registry.add(Counter('words_stats_bot_handler_errors_total', 'Update handlers that raised an error', ('handler',)))
+query_seconds = registry.add(Histogram('words_stats_bot_query_seconds', 'Time queries ran in database workers', ('query',)))
+query_wait_seconds = registry.add(Histogram('words_stats_bot_query_wait_seconds', 'Time queries waited for a database worker', ('query',)))
+query_errors = registry.add(Counter('words_stats_bot_query_errors_total', 'Queries that failed or timed out', ('query',)))
+queries_in_flight = registry.add(Gauge('words_stats_bot_queries_in_flight', 'Queries that handlers are waiting for'))
+telegram_seconds = registry.add(Histogram('words_stats_bot_telegram_seconds', 'Time of telegram bot api requests', ('method',)))
+event_loop_lag_seconds = registry.add(Histogram('words_stats_bot_event_loop_lag_seconds', 'Delay of a timer on the event loop, shows blocked event loop'))
+messages_stored = registry.add(Counter('words_stats_bot_messages_stored_total', 'Messages written to database', ('type',)))
@@ -0,0 +1,50 @@
+from datetime import datetime
+import os
+
+
+migrations_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def get_migrations(engine: str) -> list:
+    # (version, file name) of the engine's migrations, files are named '<version> <description>.sql'
+    migrations = []
+    for name in os.listdir(os.path.join(migrations_path, engine)):
+        if name.endswith('.sql'):
+            migrations.append((int(name.split(' ', 1)[0]), name))
+    return sorted(migrations)
+
+
+def split_statements(script: str) -> list:
+    # migrations do not use ';' inside statements or comments
+    lines = [line for line in script.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip() != '']
+
+
+def migrate(database) -> int:
+    # applies migrations newer than the recorded schema version, databases without version are at version 0
+    with database.connection() as db:
+        cursor = db.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS Schema_Version(Version INT NOT NULL, Applied DATETIME NOT NULL, PRIMARY KEY (Version));')
+        cursor.execute('SELECT MAX(Version) FROM Schema_Version;')
+        version = cursor.fetchone()[0] or 0
+
+        for migration_version, name in get_migrations(database.engine):
+            if migration_version <= version:
+                continue
+            print(datetime.now(), f'Applying migration {name}')
+            with open(os.path.join(migrations_path, database.engine, name), encoding='utf-8') as script:
+                for statement in split_statements(script.read()):
+                    cursor.execute(statement)
+            cursor.execute('INSERT INTO Schema_Version(Version,Applied) VALUES(%s,%s);', (migration_version, datetime.utcnow()))
+            db.commit()
+            version = migration_version
+    return version
+
+
+if __name__ == '__main__':
+    # upgrades the configured database without starting the bot, e.g. for long conversions of large tables:
+    #   python migrate.py
+    from main import connect_database
+    database = connect_database()
+    print(datetime.now(), f'Database schema version {migrate(database)}')
+    database.close()
@@ -0,0 +1,59 @@
+-- Words get auto increment ids and one row per word instead of per-process hash ids,
+-- and statistics are read from daily rollups, which are filled from the existing messages.
+SET FOREIGN_KEY_CHECKS=0;
+DELETE mw FROM Messages_Words mw JOIN Words w ON mw.WordID=w.WordID WHERE w.Word IS NULL;
+DELETE FROM Words WHERE Word IS NULL;
+ALTER TABLE Words MODIFY Word VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL;
+CREATE TEMPORARY TABLE WordMap AS SELECT w.WordID AS OldID,t.NewID FROM Words w JOIN(SELECT Word,MIN(WordID) AS NewID FROM Words GROUP BY Word)t ON w.Word=t.Word WHERE w.WordID<>t.NewID;
+UPDATE Messages_Words mw JOIN WordMap m ON mw.WordID=m.OldID SET mw.WordID=m.NewID;
+DELETE w FROM Words w JOIN WordMap m ON w.WordID=m.OldID;
+DROP TEMPORARY TABLE WordMap;
+ALTER TABLE Words MODIFY WordID BIGINT NOT NULL AUTO_INCREMENT, ADD UNIQUE (Word);
+SET FOREIGN_KEY_CHECKS=1;
+
+CREATE TABLE Daily_Words(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    WordID BIGINT,
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, WordID),
+    KEY (ChatID, Day),
+    FOREIGN KEY (WordID) REFERENCES Words(WordID) ON DELETE CASCADE
+);
+
+CREATE TABLE Daily_Characters(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    Count BIGINT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day),
+    KEY (ChatID, Day)
+);
+
+CREATE TABLE Daily_Gifs(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    GifUniqueID VARCHAR(20),
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, GifUniqueID),
+    KEY (ChatID, Day)
+);
+
+CREATE TABLE Daily_Stickers(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    StickerUniqueID VARCHAR(20),
+    StickerSetName VARCHAR(65),
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, StickerUniqueID),
+    KEY (ChatID, Day)
+);
+
+-- a word is stored once per occurrence and messages are identified by their id alone before the next migrations
+INSERT INTO Daily_Words(ChatID,UserID,Day,WordID,Count) SELECT m.ChatID,m.UserID,DATE(m.Date),mw.WordID,COUNT(*) FROM Messages m JOIN Messages_Words mw ON m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID GROUP BY m.ChatID,m.UserID,DATE(m.Date),mw.WordID;
+INSERT INTO Daily_Characters(ChatID,UserID,Day,Count) SELECT m.ChatID,m.UserID,DATE(m.Date),SUM(CHAR_LENGTH(w.Word)) FROM Messages m JOIN Messages_Words mw ON m.MessageID=mw.MessageID JOIN Words w ON mw.WordID=w.WordID GROUP BY m.ChatID,m.UserID,DATE(m.Date);
+INSERT INTO Daily_Gifs(ChatID,UserID,Day,GifUniqueID,Count) SELECT m.ChatID,m.UserID,DATE(m.Date),g.GifUniqueID,COUNT(*) FROM Messages m JOIN Gifs g ON m.MessageID=g.MessageID GROUP BY m.ChatID,m.UserID,DATE(m.Date),g.GifUniqueID;
+INSERT INTO Daily_Stickers(ChatID,UserID,Day,StickerUniqueID,StickerSetName,Count) SELECT m.ChatID,m.UserID,DATE(m.Date),s.StickerUniqueID,MAX(s.StickerSetName),COUNT(*) FROM Messages m JOIN Stickers s ON m.MessageID=s.MessageID GROUP BY m.ChatID,m.UserID,DATE(m.Date),s.StickerUniqueID;
@@ -0,0 +1,40 @@
+-- Messages are identified by chat and message id, as telegram message ids are unique only inside a chat.
+-- Foreign key names are the ones generated for the tables of 'create database.sql'.
+ALTER TABLE Messages_Words DROP FOREIGN KEY Messages_Words_ibfk_1;
+ALTER TABLE Gifs DROP FOREIGN KEY Gifs_ibfk_1;
+ALTER TABLE Stickers DROP FOREIGN KEY Stickers_ibfk_1;
+
+ALTER TABLE Messages_Words ADD ChatID BIGINT NOT NULL DEFAULT 0 FIRST;
+UPDATE Messages_Words mw JOIN Messages m ON mw.MessageID=m.MessageID SET mw.ChatID=m.ChatID;
+ALTER TABLE Gifs ADD ChatID BIGINT NOT NULL DEFAULT 0 FIRST;
+UPDATE Gifs g JOIN Messages m ON g.MessageID=m.MessageID SET g.ChatID=m.ChatID;
+ALTER TABLE Stickers ADD ChatID BIGINT NOT NULL DEFAULT 0 FIRST;
+UPDATE Stickers s JOIN Messages m ON s.MessageID=m.MessageID SET s.ChatID=m.ChatID;
+
+-- covering indexes for statistics of a chat or a user in a time window and for the users of a chat
+ALTER TABLE Messages
+    MODIFY ChatID BIGINT NOT NULL,
+    MODIFY MessageID BIGINT NOT NULL,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (ChatID, MessageID),
+    ADD KEY Messages_ChatID_Date (ChatID, Date),
+    ADD KEY Messages_ChatID_UserID_Date (ChatID, UserID, Date);
+
+-- a word is stored once per occurrence, so the key of Messages_Words is not unique
+ALTER TABLE Messages_Words
+    ALTER ChatID DROP DEFAULT,
+    ADD KEY Messages_Words_Message (ChatID, MessageID, WordID),
+    ADD FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE;
+
+ALTER TABLE Gifs
+    ALTER ChatID DROP DEFAULT,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (ChatID, MessageID, GifUniqueID),
+    ADD KEY Gifs_ChatID_GifUniqueID (ChatID, GifUniqueID),
+    ADD FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE;
+
+ALTER TABLE Stickers
+    ALTER ChatID DROP DEFAULT,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (ChatID, MessageID, StickerUniqueID),
+    ADD FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE;
@@ -0,0 +1,16 @@
+-- Every word of a message is stored once with the number of its occurrences instead of once per occurrence.
+-- Existing rows are compacted into a new table, which then replaces the old one.
+CREATE TABLE Messages_Words_Counts(
+    ChatID BIGINT NOT NULL,
+    MessageID BIGINT NOT NULL,
+    WordID BIGINT NOT NULL,
+    Count INT NOT NULL,
+    PRIMARY KEY (ChatID, MessageID, WordID),
+    KEY Messages_Words_WordID (WordID),
+    FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE,
+    FOREIGN KEY (WordID) REFERENCES Words(WordID) ON DELETE CASCADE
+);
+
+INSERT INTO Messages_Words_Counts(ChatID,MessageID,WordID,Count) SELECT ChatID,MessageID,WordID,COUNT(*) FROM Messages_Words WHERE WordID IS NOT NULL GROUP BY ChatID,MessageID,WordID;
+DROP TABLE Messages_Words;
+RENAME TABLE Messages_Words_Counts TO Messages_Words;
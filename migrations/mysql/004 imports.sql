@@ -0,0 +1,6 @@
+-- Last message read from a chat history export, so an interrupted import continues after it
+CREATE TABLE Imports(
+    ChatID BIGINT NOT NULL,
+    LastMessageID BIGINT NOT NULL,
+    PRIMARY KEY (ChatID)
+);
@@ -0,0 +1,23 @@
+-- Raw messages older than the retention horizon of a chat are deleted, the daily rollups keep their statistics.
+-- Days is the horizon of the chat, default horizon is used without it, CompactedBefore is the date raw messages are deleted before.
+CREATE TABLE Retention(
+    ChatID BIGINT NOT NULL,
+    Days INT,
+    CompactedBefore DATETIME,
+    PRIMARY KEY (ChatID)
+);
+
+-- details of every gif of a chat, so top gifs can be shown after their messages are deleted
+CREATE TABLE Gif_Files(
+    ChatID BIGINT NOT NULL,
+    GifUniqueID VARCHAR(20) NOT NULL,
+    GifID VARCHAR(100),
+    Duration INT,
+    Height INT,
+    Width INT,
+    PRIMARY KEY (ChatID, GifUniqueID)
+);
+
+INSERT INTO Gif_Files(ChatID,GifUniqueID,GifID,Duration,Height,Width)
+    SELECT g.ChatID,g.GifUniqueID,g.GifID,g.Duration,g.Height,g.Width FROM Gifs g
+    JOIN(SELECT ChatID,GifUniqueID,MIN(MessageID) AS MessageID FROM Gifs GROUP BY ChatID,GifUniqueID)f ON g.ChatID=f.ChatID AND g.GifUniqueID=f.GifUniqueID AND g.MessageID=f.MessageID;
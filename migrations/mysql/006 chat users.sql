@@ -0,0 +1,19 @@
+-- Users of every chat with their first and last message and number of messages, kept up to date when messages are added,
+-- so the user picker does not scan the messages of the chat.
+CREATE TABLE Chat_Users(
+    ChatID BIGINT NOT NULL,
+    UserID BIGINT NOT NULL,
+    FirstSeen DATETIME NOT NULL,
+    LastSeen DATETIME NOT NULL,
+    Messages BIGINT NOT NULL,
+    PRIMARY KEY (ChatID, UserID),
+    KEY Chat_Users_Messages (ChatID, Messages, UserID)
+);
+
+INSERT INTO Chat_Users(ChatID,UserID,FirstSeen,LastSeen,Messages) SELECT ChatID,UserID,MIN(Date),MAX(Date),COUNT(*) FROM Messages GROUP BY ChatID,UserID;
+
+-- users whose messages were deleted by retention are only in the rollups, which do not count messages
+INSERT IGNORE INTO Chat_Users(ChatID,UserID,FirstSeen,LastSeen,Messages)
+    SELECT ChatID,UserID,MIN(Day),MAX(Day),0 FROM(
+        SELECT ChatID,UserID,Day FROM Daily_Characters UNION ALL SELECT ChatID,UserID,Day FROM Daily_Gifs UNION ALL SELECT ChatID,UserID,Day FROM Daily_Stickers
+    )t GROUP BY ChatID,UserID;
@@ -0,0 +1,16 @@
+-- Replied message of every message and daily rollups of messages and replies by hour, for the full report of a user.
+-- Replies of messages stored before are unknown, and messages deleted by retention are not counted.
+ALTER TABLE Messages ADD ReplyTo BIGINT;
+
+CREATE TABLE Daily_Activity(
+    ChatID BIGINT,
+    UserID BIGINT,
+    Day DATE,
+    Hour TINYINT,
+    Count BIGINT NOT NULL,
+    Replies BIGINT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Day, Hour),
+    KEY (ChatID, Day)
+);
+
+INSERT INTO Daily_Activity(ChatID,UserID,Day,Hour,Count,Replies) SELECT ChatID,UserID,DATE(Date),HOUR(Date),COUNT(*),0 FROM Messages GROUP BY ChatID,UserID,DATE(Date),HOUR(Date);
@@ -0,0 +1,11 @@
+-- Statistics of windows that ended (previous day, week, month and year) do not change, so they are computed once and kept.
+-- UserID is 0 for statistics of the whole chat, Result is the query result as json.
+CREATE TABLE Closed_Stats(
+    ChatID BIGINT NOT NULL,
+    UserID BIGINT NOT NULL,
+    Type VARCHAR(10) NOT NULL,
+    WindowStart DATETIME NOT NULL,
+    WindowEnd DATETIME NOT NULL,
+    Result MEDIUMTEXT NOT NULL,
+    PRIMARY KEY (ChatID, UserID, Type, WindowStart, WindowEnd)
+);
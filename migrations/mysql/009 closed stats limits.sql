@@ -0,0 +1,3 @@
+-- Kept statistics of closed windows record the number of top rows they were computed with,
+-- results kept before are deleted and computed again when they are requested.
+DELETE FROM Closed_Stats;
@@ -0,0 +1,2 @@
+-- SQLite databases are created by 'create database sqlite.sql' with interned words and daily rollups,
+-- so there is nothing to convert, the migration keeps versions of both engines the same.
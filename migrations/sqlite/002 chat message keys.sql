@@ -0,0 +1,63 @@
+-- Messages are identified by chat and message id, as telegram message ids are unique only inside a chat.
+-- SQLite cannot change primary keys, so the tables are rebuilt. Old tables are renamed first,
+-- so dropping them does not cascade into the new ones.
+BEGIN;
+ALTER TABLE Messages RENAME TO Messages_Old;
+ALTER TABLE Messages_Words RENAME TO Messages_Words_Old;
+ALTER TABLE Gifs RENAME TO Gifs_Old;
+ALTER TABLE Stickers RENAME TO Stickers_Old;
+
+-- covering indexes for statistics of a chat or a user in a time window and for the users of a chat
+CREATE TABLE Messages(
+    ChatID BIGINT NOT NULL,
+    MessageID BIGINT NOT NULL,
+    Date DATETIME,
+    UserID BIGINT,
+    PRIMARY KEY (ChatID, MessageID),
+    FOREIGN KEY (UserID) REFERENCES Users(UserID)
+);
+CREATE INDEX Messages_ChatID_Date ON Messages(ChatID, Date);
+CREATE INDEX Messages_ChatID_UserID_Date ON Messages(ChatID, UserID, Date);
+
+-- a word is stored once per occurrence, so the key of Messages_Words is not unique
+CREATE TABLE Messages_Words(
+    ChatID BIGINT NOT NULL,
+    MessageID BIGINT NOT NULL,
+    WordID BIGINT,
+    FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE,
+    FOREIGN KEY (WordID) REFERENCES Words(WordID) ON DELETE CASCADE
+);
+CREATE INDEX Messages_Words_Message ON Messages_Words(ChatID, MessageID, WordID);
+CREATE INDEX Messages_Words_WordID ON Messages_Words(WordID);
+
+CREATE TABLE Gifs(
+    ChatID BIGINT NOT NULL,
+    MessageID BIGINT NOT NULL,
+    GifUniqueID VARCHAR(20),
+    GifID VARCHAR(100),
+    Duration INT,
+    Height INT,
+    Width INT,
+    PRIMARY KEY (ChatID, MessageID, GifUniqueID),
+    FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE
+);
+CREATE INDEX Gifs_ChatID_GifUniqueID ON Gifs(ChatID, GifUniqueID);
+
+CREATE TABLE Stickers(
+    ChatID BIGINT NOT NULL,
+    MessageID BIGINT NOT NULL,
+    StickerUniqueID VARCHAR(20),
+    StickerSetName VARCHAR(65),
+    PRIMARY KEY (ChatID, MessageID, StickerUniqueID),
+    FOREIGN KEY (ChatID, MessageID) REFERENCES Messages(ChatID, MessageID) ON DELETE CASCADE
+);
+
+INSERT INTO Messages(ChatID,MessageID,Date,UserID) SELECT ChatID,MessageID,Date,UserID FROM Messages_Old;
+INSERT INTO Messages_Words(ChatID,MessageID,WordID) SELECT m.ChatID,mw.MessageID,mw.WordID FROM Messages_Words_Old mw JOIN Messages_Old m ON mw.MessageID=m.MessageID;
+INSERT INTO Gifs(ChatID,MessageID,GifUniqueID,GifID,Duration,Height,Width) SELECT m.ChatID,g.MessageID,g.GifUniqueID,g.GifID,g.Duration,g.Height,g.Width FROM Gifs_Old g JOIN Messages_Old m ON g.MessageID=m.MessageID;
+INSERT INTO Stickers(ChatID,MessageID,StickerUniqueID,StickerSetName) SELECT m.ChatID,s.MessageID,s.StickerUniqueID,s.StickerSetName FROM Stickers_Old s JOIN Messages_Old m ON s.MessageID=m.MessageID;
+
+DROP TABLE Messages_Words_Old;
+DROP TABLE Gifs_Old;
+DROP TABLE Stickers_Old;
+DROP TABLE Messages_Old;
@@ -0,0 +1,35 @@
+from mysql.connector.pooling import MySQLConnectionPool
+import mysql.connector
+from database import Database
+
+
+class MySQLDatabase(Database):
+    pool: MySQLConnectionPool
+    stats_pool: MySQLConnectionPool
+    connection_args: dict
+
+    def __init__(self, pool_size: int, stats_pool_size: int, query_timeout: float, stats_timeout: float, word_cache_size: int, **connection_args):
+        super().__init__(pool_size, stats_pool_size, query_timeout, stats_timeout, word_cache_size)
+        self.pool = MySQLConnectionPool(pool_name='words_stats_bot', pool_size=pool_size, **connection_args)
+        self.stats_pool = MySQLConnectionPool(pool_name='words_stats_bot_stats', pool_size=stats_pool_size, **connection_args)
+        self.connection_args = connection_args
+
+    def get_connection(self, stats: bool):
+        # closing a pooled connection returns it to the pool
+        if not stats:
+            return self.pool.get_connection()
+        db = self.stats_pool.get_connection()
+        # session is reset when the connection is returned, so the limit of select statements is set on every checkout
+        cursor = db.cursor()
+        cursor.execute('SET SESSION MAX_EXECUTION_TIME=%s;', (int(self.stats_timeout * 1000),))
+        cursor.close()
+        return db
+
+    def get_stream_connection(self):
+        # unbuffered cursors fetch rows from the server while they are read instead of loading the whole result
+        return mysql.connector.connect(buffered=False, **self.connection_args)
+
+    def upsert(self, table: str, columns: tuple, keys: tuple, add: tuple = (), replace: tuple = (), least: tuple = (), greatest: tuple = ()) -> str:
+        updates = [f'{column}={column}+VALUES({column})' for column in add] + [f'{column}=VALUES({column})' for column in replace]
+        updates += [f'{column}=LEAST({column},VALUES({column}))' for column in least] + [f'{column}=GREATEST({column},VALUES({column}))' for column in greatest]
+        return f"INSERT INTO {table}({','.join(columns)}) VALUES({','.join(['%s'] * len(columns))}) ON DUPLICATE KEY UPDATE {','.join(updates)};"
@@ -0,0 +1,101 @@
+from datetime import datetime, date, timedelta
+from collections import defaultdict
+
+
+def split_window(start: datetime, end: datetime) -> tuple:
+    # returns first and last day that lie completely inside [start, end] and the partial day ranges left over
+    if end >= datetime.utcnow():
+        # nothing is stored after now, so the current day is complete in the rollups
+        end = datetime.max
+    first_day = start.date() if start.time() == datetime.min.time() else start.date() + timedelta(days=1)
+    last_day = (end - timedelta(hours=23, minutes=59, seconds=59)).date() if end - datetime.min >= timedelta(days=1) else date.min
+    if first_day > last_day:
+        return (None, None, [(start, end)])
+
+    tails = []
+    if start < datetime.combine(first_day, datetime.min.time()):
+        tails.append((start, datetime.combine(first_day, datetime.min.time()) - timedelta(microseconds=1)))
+    if last_day < date.max and datetime.combine(last_day + timedelta(days=1), datetime.min.time()) <= end:
+        tails.append((datetime.combine(last_day + timedelta(days=1), datetime.min.time()), end))
+    return (first_day, last_day, tails)
+
+
+def window_source(rollup: str, raw: str, chat_id: int, user_id: int, start: datetime, end: datetime) -> tuple:
+    # union of rollup rows for whole days and raw rows for partial days,
+    # rollup query has to end with "WHERE ChatID=%s" and raw query with "WHERE m.ChatID=%s"
+    first_day, last_day, tails = split_window(start, end)
+    parts = []
+    params = []
+    if first_day is not None:
+        parts.append(rollup + ('' if user_id is None else ' AND UserID=%s') + ' AND Day>=%s AND Day<=%s')
+        params += [chat_id] + ([] if user_id is None else [user_id]) + [first_day, last_day]
+    if len(tails) > 0:
+        parts.append(raw + ('' if user_id is None else ' AND m.UserID=%s') + ' AND(' + ' OR '.join(['(m.Date>=%s AND m.Date<=%s)'] * len(tails)) + ')')
+        params += [chat_id] + ([] if user_id is None else [user_id]) + [bound for tail in tails for bound in tail]
+    return (' UNION ALL '.join(parts), params)
+
+
+class RollupBatch:
+    words: defaultdict
+    characters: defaultdict
+    gifs: defaultdict
+    stickers: dict
+    activity: defaultdict
+
+    def __init__(self):
+        # (chat id, user id, day, word id) -> count
+        self.words = defaultdict(int)
+        # (chat id, user id, day) -> count
+        self.characters = defaultdict(int)
+        # (chat id, user id, day, gif unique id) -> count
+        self.gifs = defaultdict(int)
+        # (chat id, user id, day, sticker unique id) -> [sticker set name, count]
+        self.stickers = {}
+        # (chat id, user id, day, utc hour) -> [messages, replies]
+        self.activity = defaultdict(lambda: [0, 0])
+
+    def add_message(self, chat_id: int, user_id: int, date: datetime, reply_to: int, sign: int = 1):
+        activity = self.activity[(chat_id, user_id, date.date(), date.hour)]
+        activity[0] += sign
+        activity[1] += sign if reply_to is not None else 0
+
+    def add_words(self, chat_id: int, user_id: int, date: datetime, word_counts: dict, characters: int, sign: int = 1):
+        # word_counts is word id -> occurrences
+        day = date.date()
+        for word_id, count in word_counts.items():
+            self.words[(chat_id, user_id, day, word_id)] += sign * count
+        self.characters[(chat_id, user_id, day)] += sign * characters
+
+    def add_gif(self, chat_id: int, user_id: int, date: datetime, gif_unique_id: str, sign: int = 1):
+        self.gifs[(chat_id, user_id, date.date(), gif_unique_id)] += sign
+
+    def add_sticker(self, chat_id: int, user_id: int, date: datetime, sticker_unique_id: str, sticker_set_name: str, sign: int = 1):
+        key = (chat_id, user_id, date.date(), sticker_unique_id)
+        if key not in self.stickers:
+            self.stickers[key] = [sticker_set_name, 0]
+        self.stickers[key][1] += sign
+
+    def write(self, cursor, database):
+        if len(self.words) > 0:
+            cursor.executemany(database.upsert('Daily_Words', ('ChatID', 'UserID', 'Day', 'WordID', 'Count'), ('ChatID', 'UserID', 'Day', 'WordID'), add=('Count',)),
+                               [key + (count,) for key, count in self.words.items()])
+        if len(self.characters) > 0:
+            cursor.executemany(database.upsert('Daily_Characters', ('ChatID', 'UserID', 'Day', 'Count'), ('ChatID', 'UserID', 'Day'), add=('Count',)),
+                               [key + (count,) for key, count in self.characters.items()])
+        if len(self.gifs) > 0:
+            cursor.executemany(database.upsert('Daily_Gifs', ('ChatID', 'UserID', 'Day', 'GifUniqueID', 'Count'), ('ChatID', 'UserID', 'Day', 'GifUniqueID'), add=('Count',)),
+                               [key + (count,) for key, count in self.gifs.items()])
+        if len(self.stickers) > 0:
+            cursor.executemany(database.upsert('Daily_Stickers', ('ChatID', 'UserID', 'Day', 'StickerUniqueID', 'StickerSetName', 'Count'), ('ChatID', 'UserID', 'Day', 'StickerUniqueID'), add=('Count',)),
+                               [key + tuple(value) for key, value in self.stickers.items()])
+        if len(self.activity) > 0:
+            cursor.executemany(database.upsert('Daily_Activity', ('ChatID', 'UserID', 'Day', 'Hour', 'Count', 'Replies'), ('ChatID', 'UserID', 'Day', 'Hour'), add=('Count', 'Replies')),
+                               [key + tuple(value) for key, value in self.activity.items()])
+
+        # remove rows that were decremented to zero by deleted messages
+        days = {key[:3] for counts in (self.words, self.characters, self.gifs) for key, count in counts.items() if count < 0}
+        days.update({key[:3] for key, value in self.stickers.items() if value[1] < 0})
+        days.update({key[:3] for key, value in self.activity.items() if value[0] < 0})
+        for table in ('Daily_Words', 'Daily_Characters', 'Daily_Gifs', 'Daily_Stickers', 'Daily_Activity'):
+            if len(days) > 0:
+                cursor.executemany(f"DELETE FROM {table} WHERE ChatID=%s AND UserID=%s AND Day=%s AND Count<=0;", list(days))
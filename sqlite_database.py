@@ -0,0 +1,95 @@
+from datetime import datetime, date, timezone
+from database import Database
+import sqlite3
+import queue
+import time
+import os
+
+
+# dates are stored as fixed width utc text, so they compare in the same order as the datetimes
+def adapt_datetime(value: datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(' ', 'microseconds')
+
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('DATE', lambda value: date.fromisoformat(value.decode()))
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    # queries are written with %s placeholders of mysql connector
+    def execute(self, query: str, parameters=()):
+        return super().execute(query.replace('%s', '?'), parameters)
+
+    def executemany(self, query: str, parameters):
+        return super().executemany(query.replace('%s', '?'), parameters)
+
+
+class SQLiteConnection(sqlite3.Connection):
+    # pool the connection is returned to
+    pool: queue.Queue
+
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+
+class SQLiteDatabase(Database):
+    pool: queue.Queue
+    stats_pool: queue.Queue
+    path: str
+    engine = 'sqlite'
+    insert_ignore = 'INSERT OR IGNORE'
+    char_length = 'LENGTH'
+    hour_of = "CAST(STRFTIME('%H',{}) AS INTEGER)"
+    schema = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create database sqlite.sql')
+
+    def __init__(self, path: str, pool_size: int, stats_pool_size: int, query_timeout: float, stats_timeout: float, word_cache_size: int):
+        super().__init__(pool_size, stats_pool_size, query_timeout, stats_timeout, word_cache_size)
+        self.pool = queue.Queue()
+        self.stats_pool = queue.Queue()
+        self.path = path
+        for pool, size in ((self.pool, pool_size), (self.stats_pool, stats_pool_size)):
+            for _ in range(size):
+                # connections are handed between worker threads, but used by one thread at a time
+                db = sqlite3.connect(path, timeout=query_timeout, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, factory=SQLiteConnection)
+                # readers do not block the writer and commits do not wait for the disk on every transaction
+                db.execute('PRAGMA journal_mode=WAL;')
+                db.execute('PRAGMA synchronous=NORMAL;')
+                db.execute('PRAGMA foreign_keys=ON;')
+                db.pool = pool
+                pool.put(db)
+
+        with self.connection() as db:
+            # new database starts from the schema of 'create database.sql', migrations bring it up to date
+            if db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='Settings';").fetchone() is None:
+                with open(self.schema, encoding='utf-8') as schema:
+                    db.executescript(schema.read())
+
+    def get_connection(self, stats: bool):
+        if not stats:
+            return self.pool.get()
+        db = self.stats_pool.get()
+        # sqlite calls the handler while a statement runs and interrupts the statement once it returns true
+        deadline = time.monotonic() + self.stats_timeout
+        db.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        return db
+
+    def release_connection(self, db):
+        db.pool.put(db)
+
+    def get_stream_connection(self):
+        # sqlite cursors step through results as rows are fetched, and readers of a wal database do not block the writer
+        return sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, factory=SQLiteConnection)
+
+    def upsert(self, table: str, columns: tuple, keys: tuple, add: tuple = (), replace: tuple = (), least: tuple = (), greatest: tuple = ()) -> str:
+        updates = [f'{column}={column}+excluded.{column}' for column in add] + [f'{column}=excluded.{column}' for column in replace]
+        updates += [f'{column}=MIN({column},excluded.{column})' for column in least] + [f'{column}=MAX({column},excluded.{column})' for column in greatest]
+        return f"INSERT INTO {table}({','.join(columns)}) VALUES({','.join(['%s'] * len(columns))}) ON CONFLICT({','.join(keys)}) DO UPDATE SET {','.join(updates)};"
+
+    def close(self):
+        super().close()
+        for pool in (self.pool, self.stats_pool):
+            while not pool.empty():
+                pool.get().close()
@@ -0,0 +1,51 @@
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import asyncio
+
+
+def update_chat_id(update: object) -> int:
+    # chat of the update, None for updates without chat
+    return update.effective_chat.id if isinstance(update, Update) and update.effective_chat is not None else None
+
+
+def chat_shard(chat_id: int, shards: int) -> int:
+    # shard that processes updates of the chat, updates without chat go to the first one
+    return 0 if chat_id is None else chat_id % shards
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # processes updates of different chats concurrently and updates of one chat in the order they were received,
+    # so a message is always stored before its edit
+    chat_locks: dict
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat id -> [lock, number of updates holding or waiting for it]
+        self.chat_locks = {}
+
+    async def process_update(self, update: object, coroutine):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # updates are started in the order they were received and the lock wakes up waiters in order,
+        # chat lock is taken before a processing slot, so waiting updates of a busy chat do not hold slots
+        chat_lock = self.chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        chat_lock[1] += 1
+        try:
+            async with chat_lock[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            chat_lock[1] -= 1
+            if chat_lock[1] == 0:
+                del self.chat_locks[chat_id]
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,111 @@
+from telegram.ext import Application, TypeHandler, ContextTypes
+from telegram import Update
+from datetime import datetime
+import multiprocessing
+import asyncio
+import signal
+import os
+from main import Bot, connect_database, run_application
+from migrate import migrate
+from update_processor import update_chat_id, chat_shard
+
+
+def run_worker(index: int, count: int, updates, acks):
+    # the front process stops workers by sending None, so they ignore ctrl+c and termination sent to the whole process group
+    # and flush their buffers after the front stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    bot = Bot(shard=(index, count))
+    asyncio.run(bot.process_updates(updates, acks))
+
+
+class ShardedFront:
+    # receives updates from telegram and passes them to worker processes, each of them tokenizes and stores
+    # the messages of its chats with its own database connections and caches,
+    # updates of a chat always go to the same worker, which processes them in the order they were received
+    app: Application
+    context: multiprocessing.context.BaseContext
+    workers: list
+    acks: multiprocessing.Queue
+    pending: list
+    stopping: bool
+    tasks: list
+
+    def __init__(self, count: int):
+        print(datetime.now(), f'Starting front of {count} workers')
+        # workers find the schema up to date, so they do not migrate it at the same time
+        db = connect_database()
+        print(datetime.now(), f'Database schema version {migrate(db)}')
+        db.close()
+
+        # workers start from a new interpreter instead of a copy of this process with its threads
+        self.context = multiprocessing.get_context('spawn')
+        # (worker index, update id) of processed updates
+        self.acks = self.context.Queue()
+        # worker index -> update id -> update sent to the worker and not processed yet
+        self.pending = [{} for _ in range(count)]
+        # worker index -> (process, queue of updates)
+        self.workers = [None] * count
+        self.stopping = False
+        self.tasks = []
+        for index in range(count):
+            self.start_worker(index)
+
+        self.app = Application.builder().token(os.getenv('words_stats_bot_token')).post_init(self.post_init).post_stop(self.post_stop).build()
+        self.app.add_handler(TypeHandler(Update, self.dispatch))
+
+    def start(self):
+        print(datetime.now(), 'Running front')
+        run_application(self.app)
+
+    def start_worker(self, index: int):
+        # queue of a crashed worker may be broken, so every worker process gets a new one
+        updates = self.context.Queue()
+        process = self.context.Process(target=run_worker, args=(index, len(self.workers), updates, self.acks), name=f'words-stats-worker-{index}', daemon=True)
+        process.start()
+        self.workers[index] = (process, updates)
+        # updates a crashed worker did not process are sent again in the order they were received
+        for data in self.pending[index].values():
+            updates.put(data)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        index = chat_shard(update_chat_id(update), len(self.workers))
+        data = update.to_dict()
+        self.pending[index][update.update_id] = data
+        self.workers[index][1].put(data)
+
+    async def receive_acks(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            ack = await loop.run_in_executor(None, self.acks.get)
+            if ack is None:
+                return
+            self.pending[ack[0]].pop(ack[1], None)
+
+    async def watch_workers(self):
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for index, (process, _) in enumerate(self.workers):
+                if not process.is_alive() and not self.stopping:
+                    print(datetime.now(), f'Worker {index} exited with code {process.exitcode}, restarting it with {len(self.pending[index])} unprocessed updates')
+                    self.start_worker(index)
+
+    async def post_init(self, app: Application):
+        self.tasks = [asyncio.create_task(self.receive_acks()), asyncio.create_task(self.watch_workers())]
+
+    async def post_stop(self, app: Application):
+        # runs after polling stopped, workers process the updates they got, flush their buffers and exit
+        self.stopping = True
+        for process, updates in self.workers:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for index, (process, _) in enumerate(self.workers):
+            await loop.run_in_executor(None, process.join, float(os.getenv('words_stats_bot_worker_stop_timeout', 60)))
+            if process.is_alive():
+                # workers ignore SIGTERM
+                print(datetime.now(), f'Worker {index} did not stop, killing it')
+                process.kill()
+        # acks of the last updates are read before the queue is closed
+        self.acks.put(None)
+        await self.tasks[0]
+        self.tasks[1].cancel()